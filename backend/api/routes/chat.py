@@ -2,26 +2,37 @@
 Chat API Routes
 Handles multi-turn conversations with optional image/CSV context
 """
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Depends, Query
+from sse_starlette.sse import EventSourceResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Send
+from datetime import datetime
+from sqlalchemy.orm import Session
 from typing import Optional
-import json
+import anyio
+import orjson
+import os
 
+from database.models import get_db
 from database.repository import (
+    get_db_session,
     create_conversation,
+    create_conversation_with_message,
     get_conversation,
     get_all_conversations,
     delete_conversation,
     add_message,
+    append_message_content,
     get_messages,
+    get_messages_page,
     get_message_history_for_llm,
-    get_active_image,
+    get_active_image_url,
     get_active_csv,
     get_csv_summary,
     get_conversation_context,
     clear_all_context
 )
-from services.llm_service import get_llm_service
+from services.llm_service import LLMService, get_llm_service, to_image_data_url
 from schemas.models import (
     ChatRequest,
     ChatResponse,
@@ -32,81 +43,155 @@ from schemas.models import (
 
 router = APIRouter(prefix="/api/chat", tags=["Chat"])
 
+# Seconds between SSE keep-alive comments, so proxies with 30-60s idle timeouts
+# don't drop the connection while the LLM is still prefilling
+SSE_PING_INTERVAL = int(os.getenv("SSE_PING_INTERVAL", 15))
+SSE_KEEPALIVE_FRAME = b": keep-alive\n\n"
+
+# Streamed chunks buffered before the assistant message is written/extended in the database
+# (each chunk is already a batch of up to LLM_STREAM_N tokens)
+PERSIST_EVERY_N_CHUNKS = 8
+
+# Paginated message lists (opt-in: requests without `limit` / `before_ts` get every message)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def _sse_frame(payload: dict) -> bytes:
+    """Encode a payload as a ready-to-send SSE data frame"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+class BytesEventSourceResponse(EventSourceResponse):
+    """
+    EventSourceResponse for generators that already yield encoded SSE frames.
+    Keeps sse-starlette's ping / disconnect handling, but sends each frame straight to the
+    ASGI `send` instead of going through ensure_bytes() and a per-chunk debug log that
+    decodes every frame.
+    """
+    
+    async def stream_response(self, send: Send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        async for frame in self.body_iterator:
+            await send({"type": "http.response.body", "body": frame, "more_body": True})
+        
+        async with self._send_lock:
+            self.active = False
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
 # ============ STREAMING ENDPOINT ============
 
 @router.post("/stream")
-async def send_message_stream(request: ChatRequest):
+async def send_message_stream(
+    request: ChatRequest,
+    llm_service: LLMService = Depends(get_llm_service),
+    db: Session = Depends(get_db)
+):
     """
     Send a message and receive AI response with streaming.
     Returns Server-Sent Events (SSE) for real-time updates.
     """
-    llm_service = get_llm_service()
-    
-    # Get or create session
+    # Get or create session, and save user message
     session_id = request.session_id
     
+    conv = None
     if session_id:
-        conv = get_conversation(session_id)
-        if not conv:
-            conv = create_conversation()
-            session_id = conv["id"]
+        conv = await run_in_threadpool(get_conversation, db, session_id, include_messages=False)
+    
+    if conv:
+        # Read before the user message is written, so the history holds only earlier turns
+        history = await run_in_threadpool(get_message_history_for_llm, db, session_id)
+        await run_in_threadpool(add_message, db, session_id, role="user", content=request.message)
     else:
-        conv = create_conversation()
+        # New session: conversation and first message in a single commit
+        history = []
+        conv = await run_in_threadpool(create_conversation_with_message, db, role="user", content=request.message)
         session_id = conv["id"]
     
-    # Save user message
-    add_message(session_id, role="user", content=request.message)
-    
     # Get context for LLM
-    active_image = get_active_image(session_id)
-    active_csv = get_active_csv(session_id)
-    csv_summary = get_csv_summary(session_id)
-    history = get_message_history_for_llm(session_id)
+    active_csv = await run_in_threadpool(get_active_csv, db, session_id)
+    csv_summary = await run_in_threadpool(get_csv_summary, db, session_id)
     
-    # Use pasted image if provided, otherwise use stored image
-    image_to_use = request.image_base64 or active_image
+    # Use pasted image if provided, otherwise use stored image (only read and encoded when needed)
+    if request.image_base64:
+        image_to_use = await run_in_threadpool(to_image_data_url, request.image_base64)
+    else:
+        image_to_use = await run_in_threadpool(get_active_image_url, db, session_id)
     
     async def generate():
-        full_response = ""
+        # The request-scoped session is closed once the endpoint returns, before the body
+        # is streamed, so the generator persists the reply through its own session
+        stream_db = get_db_session()
+        pending: list[str] = []
+        message_id = None
+        
+        async def flush():
+            """Persist buffered chunks: create the assistant message on first flush, append afterwards"""
+            nonlocal message_id
+            if not pending:
+                return
+            text = "".join(pending)
+            pending.clear()
+            if message_id is None:
+                message = await run_in_threadpool(add_message, stream_db, session_id, role="assistant", content=text)
+                message_id = message["id"]
+            else:
+                await run_in_threadpool(append_message_content, stream_db, session_id, message_id, text)
         
         # Send session_id first
-        yield f"data: {json.dumps({'type': 'session', 'session_id': session_id})}\n\n"
+        yield session_frame
         
         try:
             async for chunk in llm_service.generate_response_stream(
                 message=request.message,
-                history=history[:-1],
-                image_base64=image_to_use,
+                history=history,
+                image_url=image_to_use,
                 csv_context=active_csv,
                 csv_summary=csv_summary
             ):
-                full_response += chunk
-                yield f"data: {json.dumps({'type': 'chunk', 'content': chunk})}\n\n"
+                pending.append(chunk)
+                yield _sse_frame({"type": "chunk", "content": chunk})
+                
+                # Save the response incrementally so a dropped connection keeps the partial answer
+                if len(pending) >= PERSIST_EVERY_N_CHUNKS:
+                    await flush()
             
-            # Save complete response to database
-            add_message(session_id, role="assistant", content=full_response)
+            await flush()
             
             # Send done signal
-            yield f"data: {json.dumps({'type': 'done', 'session_id': session_id})}\n\n"
+            yield _sse_frame({"type": "done", "session_id": session_id})
             
         except Exception as e:
             error_msg = f"Error: {str(e)}"
-            yield f"data: {json.dumps({'type': 'error', 'content': error_msg})}\n\n"
+            yield _sse_frame({"type": "error", "content": error_msg})
+        finally:
+            # Also runs when the client disconnects and the stream is cancelled
+            with anyio.CancelScope(shield=True):
+                try:
+                    await flush()
+                finally:
+                    await run_in_threadpool(stream_db.close)
+    
+    session_frame = _sse_frame({"type": "session", "session_id": session_id})
     
-    return StreamingResponse(
+    # EventSourceResponse sets the SSE headers (no-cache, keep-alive, no proxy buffering)
+    # and sends a keep-alive comment every SSE_PING_INTERVAL seconds, concurrently with generate()
+    return BytesEventSourceResponse(
         generate(),
-        media_type="text/event-stream",
+        ping=SSE_PING_INTERVAL,
+        ping_message_factory=lambda: SSE_KEEPALIVE_FRAME,
+        sep="\n",
         headers={
-            # SSE headers
-        "Cache-Control": "no-cache",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",
-
-        # CORS headers
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Credentials": "true",
-        "Access-Control-Allow-Headers": "*",
-        "Access-Control-Allow-Methods": "*",
+            # CORS headers
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Credentials": "true",
+            "Access-Control-Allow-Headers": "*",
+            "Access-Control-Allow-Methods": "*",
         }
     )
 
@@ -115,9 +200,9 @@ async def send_message_stream(request: ChatRequest):
 
 
 @router.post("/session")
-async def create_session():
+def create_session(db: Session = Depends(get_db)):
     """Create a new chat session"""
-    conv = create_conversation()
+    conv = create_conversation(db)
     return {
         "session_id": conv["id"],
         "created_at": conv["created_at"]
@@ -125,25 +210,42 @@ async def create_session():
 
 
 @router.get("/history/{session_id}")
-async def get_history(session_id: str):
-    """Get chat history for a session"""
-    conv = get_conversation(session_id)
+def get_history(
+    session_id: str,
+    before_ts: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
+    """
+    Get chat history for a session: all messages, or with `limit` / `before_ts` one page
+    (newest first) plus `has_more` and `next_before`.
+    Pass the returned `next_before` timestamp and id as `before_ts` / `before_id` to load older messages.
+    """
+    paged = limit is not None or before_ts is not None
+    conv = get_conversation(db, session_id, include_messages=not paged)
     if not conv:
         raise HTTPException(status_code=404, detail="Session not found")
     
+    if not paged:
+        return {
+            "session_id": session_id,
+            "messages": conv["messages"]
+        }
+    
+    page = get_messages_page(db, session_id, before_ts=before_ts, before_id=before_id, limit=limit or DEFAULT_PAGE_SIZE)
     return {
         "session_id": session_id,
-        "messages": conv["messages"]
+        **page
     }
 
 
 @router.delete("/session/{session_id}")
-async def delete_session(session_id: str):
+def delete_session(session_id: str, db: Session = Depends(get_db)):
     """Delete a chat session"""
-    if not get_conversation(session_id):
+    if not delete_conversation(db, session_id):
         raise HTTPException(status_code=404, detail="Session not found")
     
-    delete_conversation(session_id)
     return {"message": "Session deleted successfully"}
 
 
@@ -151,51 +253,63 @@ async def delete_session(session_id: str):
 
 
 @router.get("/conversations", response_model=list[ConversationListItem])
-async def list_conversations():
+def list_conversations(db: Session = Depends(get_db)):
     """
     Get list of all conversations.
     Returns basic info for sidebar display.
     """
-    conversations = get_all_conversations()
+    conversations = get_all_conversations(db)
     return conversations
 
 
 @router.get("/sessions/{session_id}")
-async def get_session_detail(session_id: str):
+def get_session_detail(
+    session_id: str,
+    before_ts: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
     """
-    Get full details of a session including all messages and context.
+    Get details of a session including context and its messages: all of them, or with
+    `limit` / `before_ts` one page (newest first) plus `has_more` and `next_before`.
+    Pass the returned `next_before` timestamp and id as `before_ts` / `before_id` to load older messages.
     """
-    conv = get_conversation(session_id)
+    paged = limit is not None or before_ts is not None
+    conv = get_conversation(db, session_id, include_messages=not paged)
     if not conv:
         raise HTTPException(status_code=404, detail="Session not found")
     
+    if paged:
+        messages = get_messages_page(db, session_id, before_ts=before_ts, before_id=before_id, limit=limit or DEFAULT_PAGE_SIZE)
+    else:
+        messages = {"messages": conv["messages"]}
     return {
         "id": conv["id"],
         "created_at": conv["created_at"],
         "updated_at": conv["updated_at"],
-        "messages": conv["messages"],
-        "context": get_conversation_context(session_id)
+        **messages,
+        "context": conv["context_info"]
     }
 
 
 @router.delete("/sessions/{session_id}", response_model=SuccessResponse)
-async def delete_session_endpoint(session_id: str):
+def delete_session_endpoint(session_id: str, db: Session = Depends(get_db)):
     """
     Delete a session and all its messages.
     """
-    if not get_conversation(session_id):
+    if not delete_conversation(db, session_id):
         raise HTTPException(status_code=404, detail="Session not found")
     
-    delete_conversation(session_id)
     return SuccessResponse(message="Session deleted successfully")
 
 
 @router.post("/sessions", response_model=dict)
-async def create_new_session():
+def create_new_session(db: Session = Depends(get_db)):
     """
     Create a new empty session.
     """
-    conv = create_conversation()
+    conv = create_conversation(db)
     return {
         "id": conv["id"],
         "created_at": conv["created_at"],
@@ -204,35 +318,34 @@ async def create_new_session():
 
 
 @router.get("/sessions/{session_id}/context", response_model=ContextInfo)
-async def get_context_info(session_id: str):
+def get_context_info(session_id: str, db: Session = Depends(get_db)):
     """
     Get information about the current context (image/CSV) of a session.
     """
-    conv = get_conversation(session_id)
+    conv = get_conversation(db, session_id, include_messages=False)
     if not conv:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    context = get_conversation_context(session_id)
+    context = get_conversation_context(db, session_id)
     return ContextInfo(**context)
 
 
 @router.delete("/sessions/{session_id}/context", response_model=SuccessResponse)
-async def clear_context(session_id: str):
+def clear_context(session_id: str, db: Session = Depends(get_db)):
     """
     Clear all context (image and CSV) from a session.
     Useful when user wants to start fresh without creating a new session.
     """
-    conv = get_conversation(session_id)
-    if not conv:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    clear_all_context(session_id)
-    
-    # Add system message
-    add_message(
+    # Clear context and add system message in one transaction
+    cleared = clear_all_context(
+        db,
         session_id,
-        role="assistant",
-        content="Context cleared. You can now upload a new image or CSV, or continue chatting."
+        messages=[{
+            "role": "assistant",
+            "content": "Context cleared. You can now upload a new image or CSV, or continue chatting."
+        }]
     )
+    if not cleared:
+        raise HTTPException(status_code=404, detail="Session not found")
     
     return SuccessResponse(message="Context cleared successfully")
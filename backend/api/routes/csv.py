@@ -2,21 +2,25 @@
 CSV API Routes
 Handles CSV file upload, URL loading, parsing, and data analysis
 """
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
 from typing import Optional
 import httpx
 
+from database.models import get_db
 from database.repository import (
     create_conversation,
     get_conversation,
     set_active_csv,
-    add_message,
     get_active_csv,
     get_csv_summary as get_csv_summary_from_db,
     clear_csv_context
 )
-from services.csv_service import get_csv_service
+from services.csv_service import CSVService, get_csv_service
 from services.llm_service import get_llm_service
+from services.http_client import get_http_client
+from api.uploads import read_bounded, READ_CHUNK_SIZE
 from schemas.models import (
     CSVUrlRequest,
     CSVUploadResponse,
@@ -32,7 +36,9 @@ ALLOWED_EXTENSIONS = [".csv"]
 @router.post("/upload", response_model=CSVUploadResponse)
 async def upload_csv(
     file: UploadFile = File(...),
-    session_id: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    csv_service: CSVService = Depends(get_csv_service),
+    db: Session = Depends(get_db)
 ):
     """
     Upload a CSV file for analysis.
@@ -50,27 +56,12 @@ async def upload_csv(
             detail="Only CSV files are allowed"
         )
     
-    # Read and validate size
-    content = await file.read()
-    if len(content) > MAX_SIZE:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large. Maximum size is {MAX_SIZE // 1024 // 1024}MB"
-        )
-    
-    # Decode content
-    try:
-        content_str = content.decode("utf-8")
-    except UnicodeDecodeError:
-        try:
-            content_str = content.decode("latin-1")
-        except Exception:
-            raise HTTPException(status_code=400, detail="Unable to decode file. Please ensure it's a valid CSV.")
+    # Read in chunks, rejecting oversized files early
+    content = await read_bounded(file, MAX_SIZE)
     
-    # Parse CSV
-    csv_service = get_csv_service()
+    # Parse CSV (raw bytes are decoded by the parser, no intermediate str copy)
     try:
-        csv_data, summary = csv_service.parse_csv(content_str, filename)
+        csv_data, summary = await run_in_threadpool(csv_service.parse_csv, content, filename)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -78,30 +69,35 @@ async def upload_csv(
     
     # Get or create session
     if session_id:
-        conv = get_conversation(session_id)
+        conv = await run_in_threadpool(get_conversation, db, session_id, include_messages=False)
         if not conv:
-            conv = create_conversation()
+            conv = await run_in_threadpool(create_conversation, db)
             session_id = conv["id"]
     else:
-        conv = create_conversation()
+        conv = await run_in_threadpool(create_conversation, db)
         session_id = conv["id"]
     
-    # Store CSV in conversation context
-    set_active_csv(session_id, csv_data, filename, summary["text_summary"])
-    
-    # Add message showing CSV was uploaded
-    add_message(
-        session_id,
-        role="user",
-        content=f"[Uploaded CSV: {filename}]",
-        csv_data={"filename": filename, "rows": summary["row_count"], "columns": summary["column_count"]}
-    )
-    
-    # Add assistant acknowledgment with summary
-    add_message(
+    # Store CSV in conversation context together with both messages in one transaction
+    await run_in_threadpool(
+        set_active_csv,
+        db,
         session_id,
-        role="assistant",
-        content=f"I've loaded the CSV file **{filename}**.\n\n{summary['text_summary']}\n\nYou can now ask me questions like:\n- \"Summarize the dataset\"\n- \"Show stats for [column name]\"\n- \"Which column has the most missing values?\"\n- \"Plot a histogram of [numeric column]\""
+        csv_data,
+        filename,
+        summary["text_summary"],
+        messages=[
+            # Message showing CSV was uploaded
+            {
+                "role": "user",
+                "content": f"[Uploaded CSV: {filename}]",
+                "csv_data": {"filename": filename, "rows": summary["row_count"], "columns": summary["column_count"]}
+            },
+            # Assistant acknowledgment with summary
+            {
+                "role": "assistant",
+                "content": f"I've loaded the CSV file **{filename}**.\n\n{summary['text_summary']}\n\nYou can now ask me questions like:\n- \"Summarize the dataset\"\n- \"Show stats for [column name]\"\n- \"Which column has the most missing values?\"\n- \"Plot a histogram of [numeric column]\""
+            }
+        ]
     )
     
     return CSVUploadResponse(
@@ -113,7 +109,11 @@ async def upload_csv(
 
 
 @router.post("/url", response_model=CSVUploadResponse)
-async def load_csv_from_url(request: CSVUrlRequest):
+async def load_csv_from_url(
+    request: CSVUrlRequest,
+    csv_service: CSVService = Depends(get_csv_service),
+    db: Session = Depends(get_db)
+):
     """
     Load a CSV file from a URL (e.g., raw GitHub link).
     
@@ -127,21 +127,30 @@ async def load_csv_from_url(request: CSVUrlRequest):
         raise HTTPException(status_code=400, detail="Invalid URL. Must start with http:// or https://")
     
     # Fetch CSV from URL
+    too_large = HTTPException(
+        status_code=400,
+        detail=f"File too large. Maximum size is {MAX_SIZE // 1024 // 1024}MB"
+    )
     try:
-        async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-            response = await client.get(url)
+        async with get_http_client().stream("GET", url) as response:
             response.raise_for_status()
             
-            # Check content length
-            content_length = len(response.content)
+            # Reject up front when the server reports an oversized body
+            content_length = int(response.headers.get("content-length") or 0)
             if content_length > MAX_SIZE:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"File too large. Maximum size is {MAX_SIZE // 1024 // 1024}MB"
-                )
+                raise too_large
             
-            content_str = response.text
+            # Otherwise download in chunks and stop as soon as the limit is crossed
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes(READ_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_SIZE:
+                    raise too_large
+                chunks.append(chunk)
             
+            content = b"".join(chunks)
+        
     except httpx.TimeoutException:
         raise HTTPException(status_code=408, detail="Request timeout. The URL took too long to respond.")
     except httpx.HTTPStatusError as e:
@@ -155,9 +164,8 @@ async def load_csv_from_url(request: CSVUrlRequest):
         filename = "data.csv"
     
     # Parse CSV
-    csv_service = get_csv_service()
     try:
-        csv_data, summary = csv_service.parse_csv(content_str, filename)
+        csv_data, summary = await run_in_threadpool(csv_service.parse_csv, content, filename)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -166,30 +174,35 @@ async def load_csv_from_url(request: CSVUrlRequest):
     # Get or create session
     session_id = request.session_id
     if session_id:
-        conv = get_conversation(session_id)
+        conv = await run_in_threadpool(get_conversation, db, session_id, include_messages=False)
         if not conv:
-            conv = create_conversation()
+            conv = await run_in_threadpool(create_conversation, db)
             session_id = conv["id"]
     else:
-        conv = create_conversation()
+        conv = await run_in_threadpool(create_conversation, db)
         session_id = conv["id"]
     
-    # Store CSV in conversation context
-    set_active_csv(session_id, csv_data, filename, summary["text_summary"])
-    
-    # Add message showing CSV was loaded
-    add_message(
-        session_id,
-        role="user",
-        content=f"[Loaded CSV from URL: {filename}]",
-        csv_data={"filename": filename, "rows": summary["row_count"], "columns": summary["column_count"], "url": url}
-    )
-    
-    # Add assistant acknowledgment with summary
-    add_message(
+    # Store CSV in conversation context together with both messages in one transaction
+    await run_in_threadpool(
+        set_active_csv,
+        db,
         session_id,
-        role="assistant",
-        content=f"I've loaded the CSV file from the URL.\n\n**File:** {filename}\n\n{summary['text_summary']}\n\nYou can now ask me questions about this data!"
+        csv_data,
+        filename,
+        summary["text_summary"],
+        messages=[
+            # Message showing CSV was loaded
+            {
+                "role": "user",
+                "content": f"[Loaded CSV from URL: {filename}]",
+                "csv_data": {"filename": filename, "rows": summary["row_count"], "columns": summary["column_count"], "url": url}
+            },
+            # Assistant acknowledgment with summary
+            {
+                "role": "assistant",
+                "content": f"I've loaded the CSV file from the URL.\n\n**File:** {filename}\n\n{summary['text_summary']}\n\nYou can now ask me questions about this data!"
+            }
+        ]
     )
     
     return CSVUploadResponse(
@@ -201,13 +214,11 @@ async def load_csv_from_url(request: CSVUrlRequest):
 
 
 @router.delete("/clear/{session_id}")
-async def clear_csv(session_id: str):
+def clear_csv(session_id: str, db: Session = Depends(get_db)):
     """Clear the active CSV from a session"""
-    conv = get_conversation(session_id)
-    if not conv:
+    if not clear_csv_context(db, session_id):
         raise HTTPException(status_code=404, detail="Session not found")
     
-    clear_csv_context(session_id)
     return {"message": "CSV cleared successfully"}
 
 
@@ -2,19 +2,23 @@
 Image API Routes
 Handles image upload and processing for vision-based chat
 """
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
 from typing import Optional
+import asyncio
 import base64
 
+from database.models import get_db
 from database.repository import (
     create_conversation,
     get_conversation,
     set_active_image,
-    add_message,
-    get_active_image,
     clear_image_context
 )
-from services.llm_service import get_llm_service
+from services.llm_service import LLMService, get_llm_service
+from services.image_service import shrink_image_for_llm
+from api.uploads import read_bounded
 
 router = APIRouter(prefix="/api/image", tags=["Image"])
 
@@ -23,10 +27,19 @@ ALLOWED_TYPES = ["image/png", "image/jpeg", "image/jpg", "image/webp", "image/gi
 MAX_SIZE = 10 * 1024 * 1024  # 10MB
 
 
+def _get_or_create_session(db: Session, session_id: Optional[str]) -> str:
+    """ID of the given session if it exists, otherwise of a newly created one"""
+    if session_id and get_conversation(db, session_id, include_messages=False):
+        return session_id
+    return create_conversation(db)["id"]
+
+
 @router.post("/upload")
 async def upload_image(
     file: UploadFile = File(...),
-    session_id: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    llm_service: LLMService = Depends(get_llm_service),
+    db: Session = Depends(get_db)
 ):
     """
     Upload an image to chat about.
@@ -44,39 +57,44 @@ async def upload_image(
             detail=f"File type '{file.content_type}' not allowed. Supported types: PNG, JPG, WEBP, GIF"
         )
     
-    # Read and validate size
-    content = await file.read()
-    if len(content) > MAX_SIZE:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large. Maximum size is {MAX_SIZE // 1024 // 1024}MB"
-        )
+    # Read in chunks, rejecting oversized files early
+    content = await read_bounded(file, MAX_SIZE)
+    
+    # Convert to a data URL once; it's reused for the stored message and the response
+    image_data_url = f"data:{file.content_type};base64," + base64.b64encode(content).decode("utf-8")
     
-    # Convert to base64
-    base64_image = base64.b64encode(content).decode("utf-8")
-    image_data_url = f"data:{file.content_type};base64,{base64_image}"
+    async def prepare_and_analyze():
+        # The model gets a downscaled JPEG (smaller request, fewer vision tokens); the original is kept for display
+        llm_image, llm_content_type = await run_in_threadpool(shrink_image_for_llm, content, file.content_type)
+        llm_image_url = (
+            image_data_url if llm_image is content
+            else f"data:{llm_content_type};base64," + base64.b64encode(llm_image).decode("utf-8")
+        )
+        # Use LLM to analyze image automatically
+        analysis = await llm_service.analyze_image(llm_image_url, "Describe this image briefly.")
+        return llm_image, llm_content_type, analysis
     
-    # Get or create session
-    if session_id:
-        conv = get_conversation(session_id)
-        if not conv:
-            conv = create_conversation()
-            session_id = conv["id"]
-    else:
-        conv = create_conversation()
-        session_id = conv["id"]
+    # The session lookup doesn't depend on the image, so it runs while the model is analyzing it
+    (llm_image, llm_content_type, analysis), session_id = await asyncio.gather(
+        prepare_and_analyze(),
+        run_in_threadpool(_get_or_create_session, db, session_id)
+    )
     
-    # Store image in conversation context
     filename = file.filename or "uploaded_image"
-    set_active_image(session_id, base64_image, filename)
-    
-    # Use LLM to analyze image automatically
-    llm_service = get_llm_service()
-    analysis = await llm_service.analyze_image(base64_image, "Describe this image briefly.")
     
-    # Add messages
-    add_message(session_id, role="user", content=f"[Uploaded image: {filename}]", image_url=image_data_url)
-    add_message(session_id, role="assistant", content=analysis)
+    # Store the LLM-ready image in conversation context together with both messages in one transaction
+    await run_in_threadpool(
+        set_active_image,
+        db,
+        session_id,
+        llm_image,
+        filename,
+        llm_content_type,
+        messages=[
+            {"role": "user", "content": f"[Uploaded image: {filename}]", "image_url": image_data_url},
+            {"role": "assistant", "content": analysis}
+        ]
+    )
     
     return {
         "message": f"Image '{filename}' uploaded successfully",
@@ -88,12 +106,10 @@ async def upload_image(
 
 
 @router.delete("/clear/{session_id}")
-async def clear_image(session_id: str):
+def clear_image(session_id: str, db: Session = Depends(get_db)):
     """Clear the active image from a session"""
-    conv = get_conversation(session_id)
-    if not conv:
+    if not clear_image_context(db, session_id):
         raise HTTPException(status_code=404, detail="Session not found")
     
-    clear_image_context(session_id)
     return {"message": "Image cleared successfully"}
 
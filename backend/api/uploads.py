@@ -0,0 +1,25 @@
+"""
+Upload helpers shared by the image and CSV routes
+"""
+from fastapi import HTTPException, UploadFile
+
+READ_CHUNK_SIZE = 64 * 1024  # 64KB
+
+
+async def read_bounded(file: UploadFile, limit: int) -> bytes:
+    """
+    Read an uploaded file in chunks, aborting with HTTP 400 as soon as it exceeds `limit` bytes.
+    Oversized uploads are rejected without buffering the whole payload.
+    """
+    chunks = []
+    size = 0
+    while chunk := await file.read(READ_CHUNK_SIZE):
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(
+                status_code=400,
+                detail=f"File too large. Maximum size is {limit // 1024 // 1024}MB"
+            )
+        chunks.append(chunk)
+    
+    return b"".join(chunks)
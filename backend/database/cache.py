@@ -0,0 +1,204 @@
+"""
+Caches in front of the database
+- Optional Redis cache for message history sent to the LLM.
+  Enabled when REDIS_URL is set; otherwise every lookup falls through to the database.
+  The cache is best-effort: Redis errors are treated as misses.
+- Small in-process TTL caches for the active image / CSV of a conversation.
+- Optional Redis cache of full LLM completions for repeated requests (LLM_RESPONSE_CACHE_TTL).
+"""
+from typing import Any, Hashable, List, Optional
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+import os
+
+import orjson
+import redis
+
+REDIS_URL = os.getenv("REDIS_URL")
+HISTORY_TTL = 3600  # 1 hour
+# Seconds to wait on connect / each command; lookups run on the request path, so a hung
+# Redis must fail fast (RedisError -> treated as a miss) instead of blocking the worker
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", 0.2))
+
+# Singleton instance
+_redis_client: Optional[redis.Redis] = None
+
+
+def get_redis_client() -> Optional[redis.Redis]:
+    """Get or create the Redis client (None when caching is disabled)"""
+    global _redis_client
+    if _redis_client is None and REDIS_URL:
+        _redis_client = redis.Redis.from_url(
+            REDIS_URL,
+            socket_connect_timeout=REDIS_TIMEOUT,
+            socket_timeout=REDIS_TIMEOUT
+        )
+    return _redis_client
+
+
+def _history_key(conv_id: str) -> str:
+    return f"hist:{conv_id}"
+
+
+def _history_version_key(conv_id: str) -> str:
+    """Generation counter, bumped by every invalidation"""
+    return f"hist:{conv_id}:v"
+
+
+def get_cached_history(conv_id: str, limit: int) -> Optional[List[dict]]:
+    """Return cached history for (conversation, limit), or None on miss"""
+    client = get_redis_client()
+    if client is None:
+        return None
+    
+    try:
+        cached = client.hget(_history_key(conv_id), str(limit))
+    except redis.RedisError:
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+
+def get_history_version(conv_id: str) -> Optional[bytes]:
+    """Current generation of a conversation's history; read it before querying the database"""
+    client = get_redis_client()
+    if client is None:
+        return None
+    
+    try:
+        return client.get(_history_version_key(conv_id))
+    except redis.RedisError:
+        return None
+
+
+def set_cached_history(conv_id: str, limit: int, history: List[dict], version: Optional[bytes]):
+    """
+    Cache history for (conversation, limit), read from the database at generation `version`.
+    Skipped if the history was invalidated since (a concurrent write), so a stale read
+    is never cached for the full TTL.
+    """
+    client = get_redis_client()
+    if client is None:
+        return
+    
+    key = _history_key(conv_id)
+    version_key = _history_version_key(conv_id)
+    try:
+        with client.pipeline() as pipe:
+            pipe.watch(version_key)
+            if pipe.get(version_key) != version:
+                return
+            pipe.multi()
+            pipe.hset(key, str(limit), orjson.dumps(history))
+            pipe.expire(key, HISTORY_TTL)
+            pipe.execute()
+    except redis.RedisError:  # Includes WatchError: invalidated between the check and the write
+        pass
+
+
+def invalidate_history(conv_id: str):
+    """Drop all cached history for a conversation (call after writing messages)"""
+    client = get_redis_client()
+    if client is None:
+        return
+    
+    version_key = _history_version_key(conv_id)
+    try:
+        pipe = client.pipeline()
+        pipe.incr(version_key)
+        pipe.expire(version_key, HISTORY_TTL)
+        pipe.delete(_history_key(conv_id))
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+# ============ IN-PROCESS CONTEXT CACHE ============
+
+# Entries also expire after CONTEXT_TTL seconds: invalidation only reaches the worker that
+# handled the write, so this bounds how stale another worker's copy can get
+CONTEXT_TTL = 30
+CSV_CACHE_SIZE = 256
+IMAGE_CACHE_SIZE = 16  # base64 data URLs are large, keep only a few
+
+# Returned by get() on a miss (None is a valid cached value: "no active context")
+MISS = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISS
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return MISS
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+active_csv_cache = TTLCache(CSV_CACHE_SIZE, CONTEXT_TTL)
+active_image_cache = TTLCache(IMAGE_CACHE_SIZE, CONTEXT_TTL)
+
+
+# ============ LLM RESPONSE CACHE ============
+
+# Exact-match cache of full completions, keyed by a hash of (model, messages).
+# Off unless LLM_RESPONSE_CACHE_TTL > 0: replies are sampled (temperature > 0), so a hit
+# replays the previous answer instead of generating a fresh one.
+RESPONSE_CACHE_TTL = int(os.getenv("LLM_RESPONSE_CACHE_TTL", 0))
+
+
+def response_cache_enabled() -> bool:
+    return RESPONSE_CACHE_TTL > 0 and get_redis_client() is not None
+
+
+def response_cache_key(model: str, messages: List[dict]) -> str:
+    """Stable key for a request; image / CSV context is part of the messages, so it changes the key"""
+    payload = orjson.dumps({"model": model, "messages": messages}, option=orjson.OPT_SORT_KEYS)
+    return f"llm:{hashlib.sha256(payload).hexdigest()}"
+
+
+def get_cached_response(key: str) -> Optional[str]:
+    """Return the cached completion, or None on miss"""
+    if not response_cache_enabled():
+        return None
+    
+    try:
+        cached = get_redis_client().get(key)
+    except redis.RedisError:
+        return None
+    return cached.decode("utf-8") if cached is not None else None
+
+
+def set_cached_response(key: str, response: str):
+    """Cache a full completion"""
+    if not response_cache_enabled():
+        return
+    
+    try:
+        get_redis_client().setex(key, RESPONSE_CACHE_TTL, response)
+    except redis.RedisError:
+        pass
@@ -11,11 +11,23 @@ from sqlalchemy import (
     Boolean,
     Integer,
     ForeignKey,
-    JSON
+    Index,
+    JSON,
+    LargeBinary,
+    bindparam,
+    event,
+    inspect,
+    text
 )
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred
 from datetime import datetime
+import base64
+import zstandard as zstd
+import orjson
 import os
 
 DATABASE_URL = os.getenv("POSTGRES_URL")
@@ -27,21 +39,104 @@ if DATABASE_URL:
     # Fix cái vụ postgres:// cũ rích nếu có
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-    
+
 else:
     # Nếu chạy local không có env thì dùng SQLite
     DATABASE_URL = "sqlite:///./chat_app.db"
     # Chỉ SQLite mới cần cái này
     connect_args = {"check_same_thread": False}
 
+# Connection pool sizing (Postgres only).
+# Rule of thumb: pool_size ≈ max_connections / worker_count, leaving headroom
+# for max_overflow bursts. pool_timeout caps how long a request waits in the
+# queue, pool_pre_ping drops sockets killed by server idle timeouts.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 5))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 3600))
+
+# SQLite (local dev): a handful of long-lived connections
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 10))
+SQLITE_MAX_OVERFLOW = int(os.getenv("SQLITE_MAX_OVERFLOW", 20))
+
+
+def _json_dumps(value) -> str:
+    """orjson for JSON columns (CSV payloads, message metadata): several times faster than stdlib json"""
+    return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+
 # Create engine chuẩn chỉ
-engine = create_engine(
-    DATABASE_URL,
-    connect_args=connect_args
-)
+if DATABASE_URL.startswith("postgresql"):
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_pre_ping=True,
+        pool_recycle=POOL_RECYCLE,
+        json_serializer=_json_dumps,
+        json_deserializer=orjson.loads,
+        connect_args=connect_args
+    )
+else:
+    # Keep SQLite connections open between requests so each one reuses a warm page cache
+    engine = create_engine(
+        DATABASE_URL,
+        poolclass=QueuePool,
+        pool_size=SQLITE_POOL_SIZE,
+        max_overflow=SQLITE_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        json_serializer=_json_dumps,
+        json_deserializer=orjson.loads,
+        connect_args=connect_args
+    )
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """WAL lets readers run alongside the writer; the rest trades durability-on-power-loss for speed"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")  # 256MB
+        cursor.execute("PRAGMA cache_size=-65536")    # 64MB
+        cursor.close()
 
 Base = declarative_base()
 
+# Binary JSON on Postgres (no re-parse on read, indexable), plain JSON elsewhere.
+# none_as_null: Python None is stored as SQL NULL rather than JSON 'null', so partial
+# indexes on "IS NOT NULL" only cover rows that actually carry data
+JSONType = JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql")
+
+
+class CompressedBinary(TypeDecorator):
+    """
+    LargeBinary stored zstd-compressed when that makes it smaller.
+    Values are told apart by the zstd frame magic, so rows written uncompressed still read as-is.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+    ZSTD_LEVEL = 3
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        # Module-level helpers: (de)compressor objects aren't safe to share across threadpool workers
+        compressed = zstd.compress(value, self.ZSTD_LEVEL)
+        return compressed if len(compressed) < len(value) else value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = bytes(value)
+        if value.startswith(self.ZSTD_MAGIC):
+            return zstd.decompress(value)
+        return value
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # ============ DATABASE MODELS ============
@@ -63,9 +158,15 @@ class Conversation(Base):
     csv_summary = Column(Text, nullable=True)
     
     # Relationships
-    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
-    image_context = relationship("ImageContext", back_populates="conversation", uselist=False, cascade="all, delete-orphan")
-    csv_context = relationship("CSVContext", back_populates="conversation", uselist=False, cascade="all, delete-orphan")
+    # lazy="raise": related rows must be loaded explicitly (selectinload/joinedload),
+    # so an accidental per-row lazy load (N+1) fails loudly instead of silently
+    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan", order_by="Message.timestamp", lazy="raise")
+    image_context = relationship("ImageContext", back_populates="conversation", uselist=False, cascade="all, delete-orphan", lazy="raise")
+    csv_context = relationship("CSVContext", back_populates="conversation", uselist=False, cascade="all, delete-orphan", lazy="raise")
+
+    __table_args__ = (
+        Index("ix_conv_updated", "updated_at"),  # Sidebar list is ordered by updated_at
+    )
 
 
 class Message(Base):
@@ -73,19 +174,31 @@ class Message(Base):
     __tablename__ = "messages"
 
     id = Column(String(36), primary_key=True, index=True)
-    conversation_id = Column(String(36), ForeignKey("conversations.id"), nullable=False, index=True)
+    conversation_id = Column(String(36), ForeignKey("conversations.id"), nullable=False)
     role = Column(String(20), nullable=False)  # "user" or "assistant"
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
     
     # Optional metadata
     image_url = Column(Text, nullable=True)  # Data URL for image messages
-    csv_info = Column(JSON, nullable=True)   # Info about CSV upload
-    chart_data = Column(JSON, nullable=True) # Data for chart visualization
+    csv_info = Column(JSONType, nullable=True)   # Info about CSV upload
+    chart_data = Column(JSONType, nullable=True) # Data for chart visualization
     
     # Relationship
     conversation = relationship("Conversation", back_populates="messages")
 
+    __table_args__ = (
+        # Covers "messages of a conversation ordered by time" (history for LLM, message lists)
+        Index("ix_msg_conv_ts", "conversation_id", "timestamp"),
+        # Postgres only: GIN over the (sparse) CSV upload metadata for JSON key lookups
+        Index(
+            "ix_msg_csv_info",
+            "csv_info",
+            postgresql_using="gin",
+            postgresql_where=text("csv_info IS NOT NULL")
+        ).ddl_if(dialect="postgresql"),
+    )
+
 
 class ImageContext(Base):
     """Stores active image for a conversation"""
@@ -93,7 +206,8 @@ class ImageContext(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     conversation_id = Column(String(36), ForeignKey("conversations.id"), unique=True, nullable=False)
-    image_base64 = Column(Text, nullable=False)  # Base64 encoded image
+    # Raw image bytes; deferred so loading the row (or the conversation) doesn't pull the blob
+    image_bytes = deferred(Column(CompressedBinary, nullable=False))
     filename = Column(String(255), nullable=True)
     content_type = Column(String(50), nullable=True)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
@@ -114,7 +228,7 @@ class CSVContext(Base):
     columns = Column(JSON, nullable=True)        # List of column names
     numeric_columns = Column(JSON, nullable=True)
     text_columns = Column(JSON, nullable=True)
-    csv_data = Column(JSON, nullable=True)       # Actual data (limited rows for context)
+    csv_data = deferred(Column(JSON, nullable=True))  # Actual data (limited rows for context), loaded on demand
     summary_text = Column(Text, nullable=True)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     
@@ -124,9 +238,70 @@ class CSVContext(Base):
 
 # ============ DATABASE INITIALIZATION ============
 
+def _migrate_image_contexts():
+    """
+    Databases created before image_bytes replaced image_base64 (base64 text, NOT NULL):
+    add the new column, fill it from the decoded base64 and drop the old one
+    """
+    columns = {column["name"] for column in inspect(engine).get_columns("image_contexts")}
+    if "image_base64" not in columns:
+        return
+    
+    table = ImageContext.__table__
+    with engine.begin() as conn:
+        if "image_bytes" not in columns:
+            binary_type = LargeBinary().compile(dialect=engine.dialect)
+            conn.execute(text(f"ALTER TABLE image_contexts ADD COLUMN image_bytes {binary_type}"))
+        rows = conn.execute(text("SELECT id, image_base64 FROM image_contexts WHERE image_bytes IS NULL")).all()
+        if rows:
+            conn.execute(
+                table.update().where(table.c.id == bindparam("row_id")).values(image_bytes=bindparam("data")),
+                [{"row_id": row_id, "data": base64.b64decode(image_base64)} for row_id, image_base64 in rows]
+            )
+        conn.execute(text("ALTER TABLE image_contexts DROP COLUMN image_base64"))
+
+
+def _prepare_csv_info_index():
+    """
+    One-off cleanup before ix_msg_csv_info is first built (Postgres only): tables created
+    before JSONType have json rather than jsonb metadata columns (GIN needs jsonb), and
+    plain messages stored JSON 'null' instead of SQL NULL, which the partial index would cover
+    """
+    if engine.dialect.name != "postgresql" or inspect(engine).has_index("messages", "ix_msg_csv_info"):
+        return
+    
+    columns = {column["name"]: column["type"] for column in inspect(engine).get_columns("messages")}
+    with engine.begin() as conn:
+        if not isinstance(columns["csv_info"], JSONB):
+            conn.execute(text(
+                "ALTER TABLE messages "
+                "ALTER COLUMN csv_info TYPE JSONB USING csv_info::jsonb, "
+                "ALTER COLUMN chart_data TYPE JSONB USING chart_data::jsonb"
+            ))
+        conn.execute(text("UPDATE messages SET csv_info = NULL WHERE csv_info = 'null'::jsonb"))
+
+
 def init_db():
     """Create all tables"""
     Base.metadata.create_all(bind=engine)
+    _migrate_image_contexts()
+    _prepare_csv_info_index()
+
+    # create_all skips tables that already exist, so add indexes introduced later explicitly
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+    # Image bytes are already compressed app-side, keep Postgres TOAST from trying again.
+    # Checked first: the ALTER takes an ACCESS EXCLUSIVE lock, so it only runs while still needed
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            storage = conn.execute(text(
+                "SELECT attstorage FROM pg_attribute "
+                "WHERE attrelid = 'image_contexts'::regclass AND attname = 'image_bytes'"
+            )).scalar()
+            if storage != "e":
+                conn.execute(text("ALTER TABLE image_contexts ALTER COLUMN image_bytes SET STORAGE EXTERNAL"))
 
 
 def get_db():
@@ -136,7 +311,3 @@ def get_db():
         yield db
     finally:
         db.close()
-
-
-# Initialize database on import
-init_db()
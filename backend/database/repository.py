@@ -3,437 +3,615 @@ Database Repository - CRUD operations using SQLAlchemy
 Replaces in-memory database with persistent SQLite storage
 """
 from typing import List, Optional, Dict, Any
-from datetime import datetime
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.orm import Session, selectinload, joinedload
+from sqlalchemy import and_, desc, func, insert, select, lambda_stmt, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import base64
+import logging
 import uuid
-import json
 
 from .models import Conversation, Message, ImageContext, CSVContext, SessionLocal
-
+from .cache import (
+    get_cached_history,
+    get_history_version,
+    set_cached_history,
+    invalidate_history,
+    active_csv_cache,
+    active_image_cache,
+    MISS
+)
+
+logger = logging.getLogger(__name__)
+
+# Characters of the first user message shown in the sidebar
+PREVIEW_LENGTH = 50
+
+# Upload markers ("[Uploaded image: ...]", "[Loaded CSV from URL: ...]") are UI notes, not LLM context
+_SKIP_PREFIXES = ("[Uploaded", "[Loaded")
+# Built once so the history statement's lambda only references a single element
+_NOT_UPLOAD_MARKER = and_(*(~Message.content.startswith(prefix, autoescape=True) for prefix in _SKIP_PREFIXES))
 
 # ============ HELPER ============
 def get_db_session() -> Session:
-    """Get a new database session"""
+    """
+    Get a new database session (caller closes it).
+    Routes get theirs from Depends(get_db); this is for work that outlives the request,
+    like persisting a streamed response.
+    """
     return SessionLocal()
 
 
 # ============ CONVERSATION OPERATIONS ============
 
-def create_conversation(db: Session = None) -> dict:
+def _load_conversation(db: Session, conv_id: str) -> Optional[Conversation]:
+    """
+    Conversation by ID. Built as a lambda statement: the construct and its cache key
+    are created once, later calls only bind conv_id.
+    """
+    return db.execute(lambda_stmt(
+        lambda: select(Conversation).where(Conversation.id == conv_id)
+    )).scalar_one_or_none()
+
+
+def create_conversation(db: Session) -> dict:
     """Create a new conversation"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+    conv_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    conversation = Conversation(
+        id=conv_id,
+        created_at=now,
+        updated_at=now
+    )
+    db.add(conversation)
+    db.commit()
     
-    try:
-        conv_id = str(uuid.uuid4())
-        conversation = Conversation(
-            id=conv_id,
-            created_at=datetime.utcnow(),
-            updated_at=datetime.utcnow()
-        )
-        db.add(conversation)
-        db.commit()
-        db.refresh(conversation)
-        
-        return {
-            "id": conversation.id,
-            "created_at": conversation.created_at.isoformat(),
-            "updated_at": conversation.updated_at.isoformat(),
-            "messages": [],
-            "context": {
-                "active_image": None,
-                "image_filename": None,
-                "active_csv": None,
-                "csv_filename": None,
-                "csv_summary": None
-            }
+    # Built from the local values: reading attributes after commit would reload the row
+    return {
+        "id": conv_id,
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+        "messages": [],
+        "context": {
+            "active_image": None,
+            "image_filename": None,
+            "active_csv": None,
+            "csv_filename": None,
+            "csv_summary": None
         }
-    finally:
-        if close_db:
-            db.close()
+    }
 
 
-def get_conversation(conv_id: str, db: Session = None) -> Optional[dict]:
-    """Get conversation by ID"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+def create_conversation_with_message(
+    db: Session,
+    role: str,
+    content: str,
+    image_url: str = None,
+    csv_data: dict = None,
+    chart_data: dict = None
+) -> dict:
+    """Create a new conversation together with its first message (one transaction, one commit)"""
+    conv_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    conversation = Conversation(
+        id=conv_id,
+        created_at=now,
+        updated_at=now
+    )
+    db.add(conversation)
+    # The message INSERT runs right away, so the conversation row must exist first
+    db.flush()
     
-    try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        if not conversation:
-            return None
-        
-        # Get messages
-        messages = [
-            {
-                "id": msg.id,
-                "role": msg.role,
-                "content": msg.content,
-                "timestamp": msg.timestamp.isoformat(),
-                "image_url": msg.image_url,
-                "csv_data": msg.csv_info,
-                "chart_data": msg.chart_data
-            }
-            for msg in conversation.messages
-        ]
-        
-        # Get image context
-        active_image = None
-        if conversation.image_context:
-            active_image = conversation.image_context.image_base64
-        
-        # Get CSV context
-        active_csv = None
-        if conversation.csv_context:
-            active_csv = {
-                "filename": conversation.csv_context.filename,
-                "row_count": conversation.csv_context.row_count,
-                "column_count": conversation.csv_context.column_count,
-                "columns": conversation.csv_context.columns or [],
-                "numeric_columns": conversation.csv_context.numeric_columns or [],
-                "text_columns": conversation.csv_context.text_columns or [],
-                "data": conversation.csv_context.csv_data
-            }
-        
-        return {
-            "id": conversation.id,
-            "created_at": conversation.created_at.isoformat(),
-            "updated_at": conversation.updated_at.isoformat(),
-            "messages": messages,
-            "context": {
-                "active_image": active_image,
-                "image_filename": conversation.image_filename,
-                "active_csv": active_csv,
-                "csv_filename": conversation.csv_filename,
-                "csv_summary": conversation.csv_summary
-            }
+    message, = _stage_messages(db, conversation, [{
+        "role": role,
+        "content": content,
+        "image_url": image_url,
+        "csv_data": csv_data,
+        "chart_data": chart_data
+    }])
+    db.commit()
+    
+    return {
+        "id": conv_id,
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+        "messages": [message],
+        "context": {
+            "active_image": None,
+            "image_filename": None,
+            "active_csv": None,
+            "csv_filename": None,
+            "csv_summary": None
         }
-    finally:
-        if close_db:
-            db.close()
+    }
 
 
-def get_all_conversations(db: Session = None) -> List[dict]:
+def get_conversation(
+    db: Session,
+    conv_id: str,
+    include_messages: bool = True,
+    include_image: bool = False,
+    include_csv_data: bool = False
+) -> Optional[dict]:
+    """
+    Get conversation by ID.
+    With include_messages=False the message list is not loaded (returned empty).
+    The image blob and the CSV payload are only loaded when asked for
+    (context.active_image / context.active_csv.data are None otherwise).
+    """
+    # Load what's needed up front instead of lazily per relationship / deferred column
+    csv_context = joinedload(Conversation.csv_context)
+    if include_csv_data:
+        csv_context = csv_context.undefer(CSVContext.csv_data)
+    options = [csv_context]
+    if include_image:
+        options.append(joinedload(Conversation.image_context).undefer(ImageContext.image_bytes))
+    if include_messages:
+        options.append(selectinload(Conversation.messages))
+    
+    conversation = db.query(Conversation)\
+        .options(*options)\
+        .filter(Conversation.id == conv_id)\
+        .first()
+    if not conversation:
+        return None
+    
+    # Get messages
+    messages = []
+    if include_messages:
+        messages = [_message_to_dict(msg) for msg in conversation.messages]
+    
+    # Get image context
+    active_image = None
+    if include_image and conversation.image_context:
+        active_image = base64.b64encode(conversation.image_context.image_bytes).decode("utf-8")
+    
+    # Get CSV context
+    active_csv = None
+    if conversation.csv_context:
+        active_csv = {
+            "filename": conversation.csv_context.filename,
+            "row_count": conversation.csv_context.row_count,
+            "column_count": conversation.csv_context.column_count,
+            "columns": conversation.csv_context.columns or [],
+            "numeric_columns": conversation.csv_context.numeric_columns or [],
+            "text_columns": conversation.csv_context.text_columns or [],
+            "data": conversation.csv_context.csv_data if include_csv_data else None
+        }
+    
+    return {
+        "id": conversation.id,
+        "created_at": conversation.created_at.isoformat(),
+        "updated_at": conversation.updated_at.isoformat(),
+        "messages": messages,
+        "context": {
+            "active_image": active_image,
+            "image_filename": conversation.image_filename,
+            "active_csv": active_csv,
+            "csv_filename": conversation.csv_filename,
+            "csv_summary": conversation.csv_summary
+        },
+        "context_info": _context_info(conversation)
+    }
+
+
+def get_all_conversations(db: Session) -> List[dict]:
     """Get all conversations for sidebar display"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+    # Message counts in one aggregate query instead of len() per conversation
+    message_counts = db.query(Message.conversation_id, func.count(Message.id).label("message_count"))\
+        .group_by(Message.conversation_id)\
+        .subquery()
     
-    try:
-        conversations = db.query(Conversation).order_by(desc(Conversation.updated_at)).all()
-        
-        result = []
-        for conv in conversations:
-            # Get preview from first user message
+    # Preview = first user message that isn't an upload marker ("[Uploaded ...]"),
+    # one char over the limit to know whether it was truncated
+    preview_text = db.query(func.substr(Message.content, 1, PREVIEW_LENGTH + 1))\
+        .filter(
+            Message.conversation_id == Conversation.id,
+            Message.role == "user",
+            ~Message.content.startswith("[", autoescape=True)
+        )\
+        .order_by(Message.timestamp)\
+        .limit(1)\
+        .correlate(Conversation)\
+        .scalar_subquery()
+    
+    # One round-trip for the whole sidebar; no message rows are loaded
+    rows = db.query(
+            Conversation,
+            func.coalesce(message_counts.c.message_count, 0),
+            preview_text
+        )\
+        .outerjoin(message_counts, message_counts.c.conversation_id == Conversation.id)\
+        .order_by(desc(Conversation.updated_at))\
+        .all()
+    
+    result = []
+    for conv, message_count, preview in rows:
+        if preview is None:
             preview = "New conversation"
-            for msg in conv.messages:
-                if msg.role == "user" and not msg.content.startswith("["):
-                    preview = msg.content[:50] + ("..." if len(msg.content) > 50 else "")
-                    break
-            
-            result.append({
-                "id": conv.id,
-                "created_at": conv.created_at.isoformat(),
-                "updated_at": conv.updated_at.isoformat(),
-                "message_count": len(conv.messages),
-                "preview": preview,
-                "has_image": conv.has_active_image,
-                "has_csv": conv.has_active_csv
-            })
+        elif len(preview) > PREVIEW_LENGTH:
+            preview = preview[:PREVIEW_LENGTH] + "..."
         
-        return result
-    finally:
-        if close_db:
-            db.close()
-
-
-def delete_conversation(conv_id: str, db: Session = None) -> bool:
-    """Delete a conversation"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+        result.append({
+            "id": conv.id,
+            "created_at": conv.created_at.isoformat(),
+            "updated_at": conv.updated_at.isoformat(),
+            "message_count": message_count,
+            "preview": preview,
+            "has_image": conv.has_active_image,
+            "has_csv": conv.has_active_csv
+        })
     
-    try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        if conversation:
-            db.delete(conversation)
-            db.commit()
-            return True
-        return False
-    finally:
-        if close_db:
-            db.close()
+    return result
 
 
-def update_conversation_timestamp(conv_id: str, db: Session = None):
+def delete_conversation(db: Session, conv_id: str) -> bool:
+    """Delete a conversation"""
+    # Bulk deletes (children first) instead of loading the conversation to cascade in Python;
+    # the row count of the last one doubles as the existence check
+    db.query(Message).filter(Message.conversation_id == conv_id).delete()
+    db.query(ImageContext).filter(ImageContext.conversation_id == conv_id).delete()
+    db.query(CSVContext).filter(CSVContext.conversation_id == conv_id).delete()
+    deleted = db.query(Conversation).filter(Conversation.id == conv_id).delete()
+    db.commit()
+    invalidate_history(conv_id)
+    active_image_cache.pop(conv_id)
+    active_csv_cache.pop(conv_id)
+    return deleted > 0
+
+
+def update_conversation_timestamp(db: Session, conv_id: str):
     """Update the updated_at timestamp"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
-    
-    try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        if conversation:
-            conversation.updated_at = datetime.utcnow()
-            db.commit()
-    finally:
-        if close_db:
-            db.close()
+    conversation = _load_conversation(db, conv_id)
+    if conversation:
+        conversation.updated_at = datetime.utcnow()
+        db.commit()
 
 
 # ============ MESSAGE OPERATIONS ============
 
 def add_message(
+    db: Session,
     conv_id: str,
     role: str,
     content: str,
     image_url: str = None,
     csv_data: dict = None,
-    chart_data: dict = None,
-    db: Session = None
+    chart_data: dict = None
 ) -> dict:
     """Add a message to a conversation"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+    conversation = _load_conversation(db, conv_id)
+    if not conversation:
+        raise ValueError(f"Conversation {conv_id} not found")
     
-    try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        if not conversation:
-            raise ValueError(f"Conversation {conv_id} not found")
-        
-        message = Message(
-            id=str(uuid.uuid4()),
-            conversation_id=conv_id,
-            role=role,
-            content=content,
-            timestamp=datetime.utcnow(),
-            image_url=image_url,
-            csv_info=csv_data,
-            chart_data=chart_data
-        )
-        
-        db.add(message)
-        conversation.updated_at = datetime.utcnow()
-        
+    message, = _stage_messages(db, conversation, [{
+        "role": role,
+        "content": content,
+        "image_url": image_url,
+        "csv_data": csv_data,
+        "chart_data": chart_data
+    }])
+    
+    db.commit()
+    invalidate_history(conv_id)
+    
+    return message
+
+
+def append_message_content(db: Session, conv_id: str, message_id: str, content: str) -> bool:
+    """Append text to an existing message in place (content = content || :text)"""
+    updated = db.query(Message).filter(Message.id == message_id).update(
+        {Message.content: Message.content + content},
+        synchronize_session=False
+    )
+    db.commit()
+    invalidate_history(conv_id)
+    return updated > 0
+
+
+def _stage_messages(db: Session, conversation: Conversation, messages: List[dict]) -> List[dict]:
+    """Insert message rows (without committing), touch the conversation and return the serialized messages"""
+    for msg in messages:
         # Update title from first user message
-        if not conversation.title and role == "user" and not content.startswith("["):
+        content = msg["content"]
+        if not conversation.title and msg["role"] == "user" and not content.startswith("["):
             conversation.title = content[:100]
-        
-        db.commit()
-        db.refresh(message)
-        
-        return {
-            "id": message.id,
-            "role": message.role,
-            "content": message.content,
-            "timestamp": message.timestamp.isoformat(),
-            "image_url": message.image_url,
-            "csv_data": message.csv_info,
-            "chart_data": message.chart_data
+    
+    staged = _insert_messages(db, conversation.id, messages)
+    conversation.updated_at = datetime.utcnow()
+    return staged
+
+
+def _insert_messages(db: Session, conv_id: str, messages: List[dict]) -> List[dict]:
+    """
+    Insert messages with a single executemany INSERT (batched by insertmanyvalues).
+    Every column is generated here, so the serialized messages are returned without reading anything back.
+    """
+    now = datetime.utcnow()
+    # Microsecond offsets keep the batch strictly ordered by timestamp
+    rows = [
+        _new_message_row(conv_id, msg, now + timedelta(microseconds=i))
+        for i, msg in enumerate(messages)
+    ]
+    db.execute(insert(Message), rows)
+    return [_message_row_to_dict(row) for row in rows]
+
+
+def _upsert_context(db: Session, model, values: dict):
+    """Insert or replace the per-conversation context row (conversation_id is unique)"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        insert = postgresql_insert
+    elif dialect == "sqlite":
+        insert = sqlite_insert
+    else:
+        db.query(model).filter(model.conversation_id == values["conversation_id"]).delete(synchronize_session=False)
+        db.add(model(**values))
+        return
+    
+    stmt = insert(model).values(**values)
+    updates = {key: stmt.excluded[key] for key in values if key != "conversation_id"}
+    db.execute(stmt.on_conflict_do_update(index_elements=["conversation_id"], set_=updates))
+
+
+def _new_message_row(conv_id: str, msg: dict, timestamp: datetime) -> dict:
+    """Build the column values of a message row from a dict with add_message's keys"""
+    row = {
+        "id": str(uuid.uuid4()),
+        "conversation_id": conv_id,
+        "role": msg["role"],
+        "content": msg["content"],
+        "timestamp": timestamp,
+        "image_url": msg.get("image_url")
+    }
+    # JSON columns are only set when there is data: an explicit None would be stored as JSON 'null'
+    if msg.get("csv_data") is not None:
+        row["csv_info"] = msg["csv_data"]
+    if msg.get("chart_data") is not None:
+        row["chart_data"] = msg["chart_data"]
+    return row
+
+
+def _message_row_to_dict(row: dict) -> dict:
+    """Serialize the column values built by _new_message_row (same shape as _message_to_dict)"""
+    return {
+        "id": row["id"],
+        "role": row["role"],
+        "content": row["content"],
+        "timestamp": row["timestamp"].isoformat(),
+        "image_url": row["image_url"],
+        "csv_data": row.get("csv_info"),
+        "chart_data": row.get("chart_data")
+    }
+
+
+def _message_to_dict(message: Message) -> dict:
+    """Serialize a message row"""
+    return {
+        "id": message.id,
+        "role": message.role,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "image_url": message.image_url,
+        "csv_data": message.csv_info,
+        "chart_data": message.chart_data
+    }
+
+
+def get_messages(db: Session, conv_id: str) -> List[dict]:
+    """Get all messages of a conversation"""
+    messages = db.query(Message).filter(Message.conversation_id == conv_id).order_by(Message.timestamp).all()
+    return [
+        {
+            "id": msg.id,
+            "role": msg.role,
+            "content": msg.content,
+            "timestamp": msg.timestamp.isoformat(),
+            "image_url": msg.image_url,
+            "csv_data": msg.csv_info,
+            "chart_data": msg.chart_data
         }
-    finally:
-        if close_db:
-            db.close()
+        for msg in messages
+    ]
 
 
-def get_messages(conv_id: str, db: Session = None) -> List[dict]:
-    """Get all messages of a conversation"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+def get_messages_page(
+    db: Session,
+    conv_id: str,
+    before_ts: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    limit: int = 50
+) -> Dict[str, Any]:
+    """
+    Get one page of messages (keyset pagination on (timestamp, id), newest page first).
+    Returns {"messages": [...chronological...], "has_more": bool, "next_before": {"timestamp", "id"} or None};
+    pass next_before back as before_ts / before_id to load the previous page.
+    Messages often share a timestamp (rows written in one flush), so the id breaks ties at page boundaries.
+    """
+    query = db.query(Message).filter(Message.conversation_id == conv_id)
+    if before_ts is not None:
+        # Stored timestamps are naive UTC
+        if before_ts.tzinfo is not None:
+            before_ts = before_ts.astimezone(timezone.utc).replace(tzinfo=None)
+        if before_id is not None:
+            query = query.filter(tuple_(Message.timestamp, Message.id) < (before_ts, before_id))
+        else:
+            query = query.filter(Message.timestamp < before_ts)
     
-    try:
-        messages = db.query(Message).filter(Message.conversation_id == conv_id).order_by(Message.timestamp).all()
-        return [
-            {
-                "id": msg.id,
-                "role": msg.role,
-                "content": msg.content,
-                "timestamp": msg.timestamp.isoformat(),
-                "image_url": msg.image_url,
-                "csv_data": msg.csv_info,
-                "chart_data": msg.chart_data
-            }
-            for msg in messages
-        ]
-    finally:
-        if close_db:
-            db.close()
-
-
-def get_message_history_for_llm(conv_id: str, limit: int = 20, db: Session = None) -> List[dict]:
-    """Get message history formatted for LLM API"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+    # Range served by the (conversation_id, timestamp) index; fetch one extra row to know if there is more
+    rows = query.order_by(desc(Message.timestamp), desc(Message.id)).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = list(reversed(rows[:limit]))
     
-    try:
-        messages = db.query(Message)\
-            .filter(Message.conversation_id == conv_id)\
-            .order_by(desc(Message.timestamp))\
-            .limit(limit)\
-            .all()
-        
-        # Reverse to get chronological order
-        messages = list(reversed(messages))
-        
-        return [
-            {"role": msg.role, "content": msg.content}
-            for msg in messages
-        ]
-    finally:
-        if close_db:
-            db.close()
+    messages = [_message_to_dict(msg) for msg in rows]
+    return {
+        "messages": messages,
+        "has_more": has_more,
+        "next_before": {"timestamp": messages[0]["timestamp"], "id": messages[0]["id"]} if has_more else None
+    }
+
+
+def get_message_history_for_llm(db: Session, conv_id: str, limit: int = 20) -> List[dict]:
+    """
+    Get message history formatted for LLM API (served from Redis when enabled).
+    Upload markers (_SKIP_PREFIXES) are filtered out in SQL, so callers can send the rows as-is.
+    """
+    cached = get_cached_history(conv_id, limit)
+    if cached is not None:
+        return cached
+    version = get_history_version(conv_id)
+    
+    # Newest `limit` rows via a backward scan of ix_msg_conv_ts; only the two needed
+    # columns are selected, so no Message objects are built
+    rows = db.execute(lambda_stmt(
+        lambda: select(Message.role, Message.content)
+        .where(
+            Message.conversation_id == conv_id,
+            _NOT_UPLOAD_MARKER
+        )
+        .order_by(desc(Message.timestamp))
+        .limit(limit)
+    )).all()
+    
+    # Reverse to get chronological order
+    history = [{"role": role, "content": content} for role, content in reversed(rows)]
+    set_cached_history(conv_id, limit, history, version)
+    return history
 
 
 # ============ IMAGE CONTEXT OPERATIONS ============
 
-def set_active_image(conv_id: str, image_base64: str, filename: str, db: Session = None):
-    """Store the active image being discussed"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+def set_active_image(
+    db: Session,
+    conv_id: str,
+    image_bytes: bytes,
+    filename: str,
+    content_type: str = None,
+    messages: List[dict] = None
+):
+    """
+    Store the active image being discussed (raw bytes, not base64).
+    Optional messages are added in the same transaction.
+    """
+    conversation = _load_conversation(db, conv_id)
+    if not conversation:
+        return
     
-    try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        if not conversation:
-            return
-        
-        # Remove existing image context
-        existing = db.query(ImageContext).filter(ImageContext.conversation_id == conv_id).first()
-        if existing:
-            db.delete(existing)
-        
-        # Add new image context
-        image_context = ImageContext(
-            conversation_id=conv_id,
-            image_base64=image_base64,
-            filename=filename,
-            uploaded_at=datetime.utcnow()
-        )
-        db.add(image_context)
-        
-        # Update conversation flags
-        conversation.has_active_image = True
-        conversation.image_filename = filename
-        conversation.updated_at = datetime.utcnow()
-        
-        db.commit()
-    finally:
-        if close_db:
-            db.close()
+    # Replace image context (one upsert instead of select + delete + insert)
+    _upsert_context(db, ImageContext, {
+        "conversation_id": conv_id,
+        "image_bytes": image_bytes,
+        "filename": filename,
+        "content_type": content_type,
+        "uploaded_at": datetime.utcnow()
+    })
+    
+    # Update conversation flags
+    conversation.has_active_image = True
+    conversation.image_filename = filename
+    conversation.updated_at = datetime.utcnow()
+    
+    if messages:
+        _stage_messages(db, conversation, messages)
+    
+    db.commit()
+    active_image_cache.pop(conv_id)
+    if messages:
+        invalidate_history(conv_id)
 
 
-def get_active_image(conv_id: str, db: Session = None) -> Optional[str]:
-    """Get the active image (base64)"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
-    
-    try:
-        image_context = db.query(ImageContext).filter(ImageContext.conversation_id == conv_id).first()
-        return image_context.image_base64 if image_context else None
-    finally:
-        if close_db:
-            db.close()
+def get_active_image_bytes(db: Session, conv_id: str) -> Optional[bytes]:
+    """Get the raw bytes of the active image (single-column SELECT, the rest of the row is skipped)"""
+    return db.query(ImageContext.image_bytes).filter(ImageContext.conversation_id == conv_id).scalar()
 
 
-def get_image_filename(conv_id: str, db: Session = None) -> Optional[str]:
-    """Get the active image filename"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+def get_active_image_url(db: Session, conv_id: str) -> Optional[str]:
+    """
+    Get the active image as a ready-to-send data URL for the LLM (cached per conversation, see database.cache).
+    The prefix uses the MIME type stored at upload, so PNG/WEBP/GIF images aren't labelled as JPEG.
+    """
+    cached = active_image_cache.get(conv_id)
+    if cached is not MISS:
+        return cached
     
-    try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        return conversation.image_filename if conversation else None
-    finally:
-        if close_db:
-            db.close()
+    image = db.query(ImageContext.image_bytes, ImageContext.content_type)\
+        .filter(ImageContext.conversation_id == conv_id)\
+        .first()
+    image_url = None
+    if image and image.image_bytes:
+        image_url = f"data:{image.content_type or 'image/jpeg'};base64," + base64.b64encode(image.image_bytes).decode("utf-8")
+    active_image_cache.set(conv_id, image_url)
+    return image_url
 
 
-def clear_image_context(conv_id: str, db: Session = None):
-    """Clear image context"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+def get_image_filename(db: Session, conv_id: str) -> Optional[str]:
+    """Get the active image filename"""
+    return db.query(Conversation.image_filename).filter(Conversation.id == conv_id).scalar()
+
+
+def clear_image_context(db: Session, conv_id: str) -> bool:
+    """Clear image context. Returns False if the conversation doesn't exist."""
+    # Update conversation flags; the row count doubles as the existence check
+    updated = db.query(Conversation).filter(Conversation.id == conv_id).update({
+        Conversation.has_active_image: False,
+        Conversation.image_filename: None,
+        Conversation.updated_at: datetime.utcnow()
+    }, synchronize_session=False)
+    if not updated:
+        return False
     
-    try:
-        # Delete image context
-        db.query(ImageContext).filter(ImageContext.conversation_id == conv_id).delete()
-        
-        # Update conversation flags
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        if conversation:
-            conversation.has_active_image = False
-            conversation.image_filename = None
-            conversation.updated_at = datetime.utcnow()
-        
-        db.commit()
-    finally:
-        if close_db:
-            db.close()
+    # Delete image context
+    db.query(ImageContext).filter(ImageContext.conversation_id == conv_id).delete()
+    
+    db.commit()
+    active_image_cache.pop(conv_id)
+    return True
 
 
 # ============ CSV CONTEXT OPERATIONS ============
 
-def set_active_csv(conv_id: str, csv_data: dict, filename: str, summary: str, db: Session = None):
-    """Store the active CSV data being discussed"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
-    
+def set_active_csv(
+    db: Session,
+    conv_id: str,
+    csv_data: dict,
+    filename: str,
+    summary: str,
+    messages: List[dict] = None
+):
+    """
+    Store the active CSV data being discussed.
+    Optional messages are added in the same transaction.
+    """
     try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
+        conversation = _load_conversation(db, conv_id)
         if not conversation:
-            print(f"[CSV] Conversation {conv_id} not found, cannot set CSV context")
+            logger.warning("Conversation %s not found, cannot set CSV context", conv_id)
             return
         
-        # Remove existing CSV context
-        existing = db.query(CSVContext).filter(CSVContext.conversation_id == conv_id).first()
-        if existing:
-            db.delete(existing)
-            db.flush()  # Ensure deletion is processed
-        
         # Prepare full CSV data for storage (include sample_rows, numeric_stats)
         full_csv_data = {
             "sample_rows": csv_data.get("sample_rows", []),
+            "sample_rows_json": csv_data.get("sample_rows_json"),
+            "signature": csv_data.get("signature"),
             "numeric_stats": csv_data.get("numeric_stats", {}),
             "missing_values": csv_data.get("missing_values", {}),
             "dtypes": csv_data.get("dtypes", {})
         }
         
-        # Add new CSV context
-        csv_context = CSVContext(
-            conversation_id=conv_id,
-            filename=filename,
-            row_count=csv_data.get("row_count", 0),
-            column_count=len(csv_data.get("columns", [])),
-            columns=csv_data.get("columns", []),
-            numeric_columns=csv_data.get("numeric_columns", []),
-            text_columns=csv_data.get("text_columns", []),
-            csv_data=full_csv_data,  # Store full data for analysis
-            summary_text=summary,
-            uploaded_at=datetime.utcnow()
-        )
-        db.add(csv_context)
+        # Replace CSV context (one upsert instead of select + delete + flush + insert)
+        _upsert_context(db, CSVContext, {
+            "conversation_id": conv_id,
+            "filename": filename,
+            "row_count": csv_data.get("row_count", 0),
+            "column_count": len(csv_data.get("columns", [])),
+            "columns": csv_data.get("columns", []),
+            "numeric_columns": csv_data.get("numeric_columns", []),
+            "text_columns": csv_data.get("text_columns", []),
+            "csv_data": full_csv_data,  # Store full data for analysis
+            "summary_text": summary,
+            "uploaded_at": datetime.utcnow()
+        })
         
         # Update conversation flags
         conversation.has_active_csv = True
@@ -441,123 +619,144 @@ def set_active_csv(conv_id: str, csv_data: dict, filename: str, summary: str, db
         conversation.csv_summary = summary
         conversation.updated_at = datetime.utcnow()
         
+        if messages:
+            _stage_messages(db, conversation, messages)
+        
         db.commit()
-        print(f"[CSV] Successfully stored CSV context for conversation {conv_id}: {filename}")
-    except Exception as e:
-        print(f"[CSV] Error storing CSV context: {str(e)}")
+        active_csv_cache.pop(conv_id)
+        if messages:
+            invalidate_history(conv_id)
+        logger.info("Stored CSV context for conversation %s: %s", conv_id, filename)
+    except Exception:
+        logger.exception("Error storing CSV context for conversation %s", conv_id)
         db.rollback()
         raise
-    finally:
-        if close_db:
-            db.close()
 
 
-def get_active_csv(conv_id: str, db: Session = None) -> Optional[dict]:
-    """Get the active CSV data with full context for LLM"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+def get_active_csv(db: Session, conv_id: str) -> Optional[dict]:
+    """Get the active CSV data with full context for LLM (cached per conversation, see database.cache)"""
+    cached = active_csv_cache.get(conv_id)
+    if cached is not MISS:
+        return cached
     
-    try:
-        csv_context = db.query(CSVContext).filter(CSVContext.conversation_id == conv_id).first()
-        if not csv_context:
-            return None
-        
-        # Build complete CSV context for LLM
-        csv_data = csv_context.csv_data or {}
-        
-        return {
-            "filename": csv_context.filename,
-            "row_count": csv_context.row_count,
-            "column_count": csv_context.column_count,
-            "columns": csv_context.columns or [],
-            "numeric_columns": csv_context.numeric_columns or [],
-            "text_columns": csv_context.text_columns or [],
-            "sample_rows": csv_data.get("sample_rows", []),
-            "numeric_stats": csv_data.get("numeric_stats", {}),
-            "missing_values": csv_data.get("missing_values", {}),
-            "dtypes": csv_data.get("dtypes", {})
-        }
-    finally:
-        if close_db:
-            db.close()
-
-
-def get_csv_summary(conv_id: str, db: Session = None) -> Optional[str]:
+    # Column query: reads csv_data despite the deferral and skips ORM hydration
+    csv_context = db.query(
+            CSVContext.filename,
+            CSVContext.row_count,
+            CSVContext.column_count,
+            CSVContext.columns,
+            CSVContext.numeric_columns,
+            CSVContext.text_columns,
+            CSVContext.csv_data
+        )\
+        .filter(CSVContext.conversation_id == conv_id)\
+        .first()
+    if not csv_context:
+        active_csv_cache.set(conv_id, None)
+        return None
+    
+    # Build complete CSV context for LLM
+    csv_data = csv_context.csv_data or {}
+    
+    result = {
+        "filename": csv_context.filename,
+        "row_count": csv_context.row_count,
+        "column_count": csv_context.column_count,
+        "columns": csv_context.columns or [],
+        "numeric_columns": csv_context.numeric_columns or [],
+        "text_columns": csv_context.text_columns or [],
+        "sample_rows": csv_data.get("sample_rows", []),
+        "sample_rows_json": csv_data.get("sample_rows_json"),
+        "signature": csv_data.get("signature"),
+        "numeric_stats": csv_data.get("numeric_stats", {}),
+        "missing_values": csv_data.get("missing_values", {}),
+        "dtypes": csv_data.get("dtypes", {})
+    }
+    active_csv_cache.set(conv_id, result)
+    return result
+
+
+def get_csv_summary(db: Session, conv_id: str) -> Optional[str]:
     """Get the active CSV summary"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+    return db.query(Conversation.csv_summary).filter(Conversation.id == conv_id).scalar()
+
+
+def clear_csv_context(db: Session, conv_id: str) -> bool:
+    """Clear CSV context. Returns False if the conversation doesn't exist."""
+    # Update conversation flags; the row count doubles as the existence check
+    updated = db.query(Conversation).filter(Conversation.id == conv_id).update({
+        Conversation.has_active_csv: False,
+        Conversation.csv_filename: None,
+        Conversation.csv_summary: None,
+        Conversation.updated_at: datetime.utcnow()
+    }, synchronize_session=False)
+    if not updated:
+        return False
     
-    try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        return conversation.csv_summary if conversation else None
-    finally:
-        if close_db:
-            db.close()
-
-
-def clear_csv_context(conv_id: str, db: Session = None):
-    """Clear CSV context"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+    # Delete CSV context
+    db.query(CSVContext).filter(CSVContext.conversation_id == conv_id).delete()
     
-    try:
-        # Delete CSV context
-        db.query(CSVContext).filter(CSVContext.conversation_id == conv_id).delete()
-        
-        # Update conversation flags
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        if conversation:
-            conversation.has_active_csv = False
-            conversation.csv_filename = None
-            conversation.csv_summary = None
-            conversation.updated_at = datetime.utcnow()
-        
-        db.commit()
-    finally:
-        if close_db:
-            db.close()
-
-
-def clear_all_context(conv_id: str, db: Session = None):
-    """Clear all context (image and CSV)"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+    db.commit()
+    active_csv_cache.pop(conv_id)
+    return True
+
+
+def clear_all_context(db: Session, conv_id: str, messages: List[dict] = None) -> bool:
+    """
+    Clear all context (image and CSV) in one transaction.
+    Optional messages are added in the same transaction (as-is, without title updates).
+    Returns False if the conversation doesn't exist.
+    """
+    # Update conversation flags; the row count doubles as the existence check
+    updated = db.query(Conversation).filter(Conversation.id == conv_id).update({
+        Conversation.has_active_image: False,
+        Conversation.image_filename: None,
+        Conversation.has_active_csv: False,
+        Conversation.csv_filename: None,
+        Conversation.csv_summary: None,
+        Conversation.updated_at: datetime.utcnow()
+    }, synchronize_session=False)
+    if not updated:
+        return False
     
-    try:
-        clear_image_context(conv_id, db)
-        clear_csv_context(conv_id, db)
-    finally:
-        if close_db:
-            db.close()
+    db.query(ImageContext).filter(ImageContext.conversation_id == conv_id).delete()
+    db.query(CSVContext).filter(CSVContext.conversation_id == conv_id).delete()
+    
+    if messages:
+        _insert_messages(db, conv_id, messages)
+    
+    db.commit()
+    active_image_cache.pop(conv_id)
+    active_csv_cache.pop(conv_id)
+    if messages:
+        invalidate_history(conv_id)
+    return True
 
 
-def get_conversation_context(conv_id: str, db: Session = None) -> dict:
+def get_conversation_context(db: Session, conv_id: str) -> dict:
     """Get full context info for a conversation"""
-    close_db = False
-    if db is None:
-        db = get_db_session()
-        close_db = True
+    # Plain row of the five flag columns, no Conversation object is built
+    row = db.query(
+            Conversation.has_active_image,
+            Conversation.image_filename,
+            Conversation.has_active_csv,
+            Conversation.csv_filename,
+            Conversation.csv_summary
+        )\
+        .filter(Conversation.id == conv_id)\
+        .first()
+    if not row:
+        return {}
     
-    try:
-        conversation = db.query(Conversation).filter(Conversation.id == conv_id).first()
-        if not conversation:
-            return {}
-        
-        return {
-            "has_image": conversation.has_active_image,
-            "image_filename": conversation.image_filename,
-            "has_csv": conversation.has_active_csv,
-            "csv_filename": conversation.csv_filename,
-            "csv_summary": conversation.csv_summary
-        }
-    finally:
-        if close_db:
-            db.close()
+    return _context_info(row)
+
+
+def _context_info(conversation) -> dict:
+    """Build context info dict from a loaded conversation (or a row with its flag columns)"""
+    return {
+        "has_image": conversation.has_active_image,
+        "image_filename": conversation.image_filename,
+        "has_csv": conversation.has_active_csv,
+        "csv_filename": conversation.csv_filename,
+        "csv_summary": conversation.csv_summary
+    }
@@ -8,20 +8,46 @@ Features:
 - CSV upload/URL loading with data analysis
 - Streaming-ready architecture
 """
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 import uvicorn
+import logging
 import os
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# App loggers (uvicorn configures its own); LOG_LEVEL=WARNING silences per-request info logs
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+# httpx logs every outbound request (LLM, CSV URLs) at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
 # Import routers
 from api.routes.chat import router as chat_router
 from api.routes.image import router as image_router
 from api.routes.csv import router as csv_router
+from services.http_client import close_http_client
+from database.models import init_db
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """App startup/shutdown hooks"""
+    # Create tables/indexes once at startup instead of on import. With several workers,
+    # only WORKER_ID=0 runs the DDL so they don't contend for schema locks on cold start.
+    if os.getenv("WORKER_ID", "0") == "0":
+        init_db()
+    
+    yield
+    # Release pooled outbound connections
+    await close_http_client()
+
 
 # Create FastAPI app
 app = FastAPI(
@@ -52,7 +78,10 @@ app = FastAPI(
     """,
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    # orjson renders the large message / CSV sample payloads several times faster than stdlib json
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS middleware - allow frontend to call API
@@ -68,7 +97,7 @@ app.add_middleware(
 # Global exception handler
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "detail": str(exc),
@@ -6,12 +6,16 @@ from typing import Optional, List, Any
 from datetime import datetime
 
 
+# Pasted images: a 10MB image (same cap as uploads) in base64, plus room for a data URL header
+MAX_IMAGE_BASE64_LENGTH = (10 * 1024 * 1024) * 4 // 3 + 128
+
+
 # ============ CHAT SCHEMAS ============
 class ChatRequest(BaseModel):
     """Request body for sending a chat message"""
     message: str = Field(..., min_length=1, max_length=10000, description="User message")
     session_id: Optional[str] = Field(None, description="Chat session ID")
-    image_base64: Optional[str] = Field(None, description="Base64 encoded image")
+    image_base64: Optional[str] = Field(None, max_length=MAX_IMAGE_BASE64_LENGTH, description="Base64 encoded image")
 
 
 class MessageSchema(BaseModel):
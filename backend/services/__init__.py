@@ -1,3 +1,5 @@
 # Services module
 from .llm_service import LLMService, get_llm_service
 from .csv_service import CSVService, get_csv_service
+from .image_service import shrink_image_for_llm
+from .http_client import get_http_client, get_llm_http_client, close_http_client
@@ -2,98 +2,140 @@
 CSV Service - Handles CSV parsing, analysis, and chart data generation
 """
 import pandas as pd
-from io import StringIO
-from typing import Tuple, Dict, Any, List, Optional
-import json
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from io import StringIO, BytesIO
+from typing import Tuple, Dict, Any, List, Union
+from functools import lru_cache
+from collections import OrderedDict
+import hashlib
+import threading
+import logging
+
+import orjson
+
+
+logger = logging.getLogger(__name__)
+
+# pandas' default NA tokens (read_csv na_values), so the Arrow reader marks the same cells missing
+NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"
+]
 
 
 class CSVService:
     MAX_ROWS_DISPLAY = 100  # Maximum rows to send to frontend
     MAX_ROWS_CONTEXT = 1000  # Maximum rows to keep in memory
+    PARSE_CACHE_SIZE = 32  # Parsed uploads kept in memory, keyed by content hash
     
-    def parse_csv(self, content: str, filename: str = "data.csv") -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    def __init__(self):
+        self._parse_cache: "OrderedDict[Tuple[str, str], Tuple[Dict[str, Any], Dict[str, Any]]]" = OrderedDict()
+        self._parse_cache_lock = threading.Lock()
+    
+    def parse_csv(self, content: Union[str, bytes], filename: str = "data.csv") -> Tuple[Dict[str, Any], Dict[str, Any]]:
         """
         Parse CSV content and return data structure + summary
         
+        Re-uploads of the same file are served from an in-memory LRU cache
+        (the returned dicts are shared between callers, treat them as read-only).
+        
         Args:
-            content: CSV content as string
+            content: CSV content as string, or raw bytes (UTF-8 with latin-1 fallback)
             filename: Original filename
             
         Returns:
             Tuple of (csv_data dict, summary dict)
         """
+        raw = content.encode("utf-8") if isinstance(content, str) else content
+        key = (hashlib.blake2b(raw, digest_size=16).hexdigest(), filename)
+        
+        with self._parse_cache_lock:
+            cached = self._parse_cache.get(key)
+            if cached is not None:
+                self._parse_cache.move_to_end(key)
+                return cached
+        
+        result = self._parse_csv(content, filename)
+        # Content hash, so consumers can memoize work derived from this file (e.g. the LLM prompt)
+        result[0]["signature"] = key[0]
+        
+        with self._parse_cache_lock:
+            self._parse_cache[key] = result
+            self._parse_cache.move_to_end(key)
+            while len(self._parse_cache) > self.PARSE_CACHE_SIZE:
+                self._parse_cache.popitem(last=False)
+        
+        return result
+    
+    def _parse_csv(self, content: Union[str, bytes], filename: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Parse CSV content (uncached), see parse_csv"""
         try:
-            df = pd.read_csv(
-                StringIO(content),
-            )
-        except pd.errors.ParserError:
+            df, row_count = self._read_csv_arrow(content)
+        except (pd.errors.ParserError, pa.ArrowInvalid):
             # Fallback: Thử đọc bằng engine python (chậm hơn nhưng flexible hơn)
             try:
-                df = pd.read_csv(StringIO(content), engine='python', on_bad_lines='skip')
+                df = self._read_csv(content, engine='python', on_bad_lines='skip')
+                row_count = len(df)
             except Exception as e:
                 raise ValueError(f"File nát quá cứu không nổi: {str(e)}")
         except Exception as e:
             raise ValueError(f"Lỗi parse CSV: {str(e)}")
 
-        print(df)
+        logger.debug("Parsed %s: %d rows x %d columns", filename, row_count, len(df.columns))
         
-        # Limit rows for memory
-        if len(df) > self.MAX_ROWS_CONTEXT:
-            df_full = df.copy()
+        # Limit rows for memory (rows past the limit are only counted, never kept)
+        truncated = row_count > self.MAX_ROWS_CONTEXT
+        if truncated:
             df = df.head(self.MAX_ROWS_CONTEXT)
-            truncated = True
-        else:
-            df_full = df
-            truncated = False
         
         # Identify column types
         numeric_columns = df.select_dtypes(include=['number']).columns.tolist()
         text_columns = df.select_dtypes(include=['object', 'category']).columns.tolist()
         datetime_columns = df.select_dtypes(include=['datetime']).columns.tolist()
         
-        # Generate numeric statistics
+        # Generate numeric statistics (all columns in one vectorized pass)
         numeric_stats = {}
-        for col in numeric_columns:
-            col_data = df[col].dropna()
-            if len(col_data) > 0:
+        numeric_df = df[numeric_columns]
+        missing = numeric_df.isnull().sum()
+        # All-empty columns get no stats
+        numeric_df = numeric_df.loc[:, numeric_df.count() > 0]
+        if len(numeric_df.columns):
+            stats = numeric_df.agg(["mean", "median", "min", "max", "std", "count"])
+            # Round the whole frame at once; to_dict() boxes every value in a single pass
+            for col, col_stats in stats.round(2).to_dict().items():
+                count = int(col_stats["count"])
                 numeric_stats[col] = {
-                    "mean": round(float(col_data.mean()), 2),
-                    "median": round(float(col_data.median()), 2),
-                    "min": round(float(col_data.min()), 2),
-                    "max": round(float(col_data.max()), 2),
-                    "std": round(float(col_data.std()), 2) if len(col_data) > 1 else 0,
-                    "count": int(col_data.count()),
-                    "missing": int(df[col].isnull().sum())
+                    **col_stats,
+                    "std": col_stats["std"] if count > 1 else 0,  # NaN for single-value columns
+                    "count": count,
+                    "missing": int(missing[col])
                 }
         
         # Missing values analysis
-        missing_values = df.isnull().sum().to_dict()
-        missing_values = {k: int(v) for k, v in missing_values.items()}
+        missing_series = df.isnull().sum()
+        missing_values = missing_series.astype(int).to_dict()
         
         # Find most missing column
         most_missing_col = None
-        most_missing_count = 0
-        for col, count in missing_values.items():
-            if count > most_missing_count:
-                most_missing_count = count
-                most_missing_col = col
+        most_missing_count = int(missing_series.max()) if len(missing_series) else 0
+        if most_missing_count > 0:
+            most_missing_col = str(missing_series.idxmax())
         
-        # Sample rows for display and context
+        # Sample rows for display and context (missing cells become "", so no NaN reaches JSON)
         sample_rows = df.head(self.MAX_ROWS_DISPLAY).fillna("").to_dict(orient="records")
-        
-        # Clean sample rows (convert any remaining NaN)
-        for row in sample_rows:
-            for key, value in row.items():
-                if pd.isna(value):
-                    row[key] = None
-                elif isinstance(value, float) and value != value:  # NaN check
-                    row[key] = None
+        # The LLM prompt shows the first 5 rows as JSON; serialize them once here, not on every turn
+        sample_rows_json = orjson.dumps(
+            sample_rows[:5],
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        ).decode("utf-8")
         
         # Build CSV data structure
         csv_data = {
             "filename": filename,
             "columns": df.columns.tolist(),
-            "row_count": len(df_full),
+            "row_count": row_count,
             "displayed_rows": len(df),
             "truncated": truncated,
             "numeric_columns": numeric_columns,
@@ -101,15 +143,16 @@ class CSVService:
             "datetime_columns": datetime_columns,
             "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
             "sample_rows": sample_rows,
+            "sample_rows_json": sample_rows_json,
             "numeric_stats": numeric_stats,
             "missing_values": missing_values
         }
         
         # Build summary
-        text_summary = self._generate_text_summary(df_full, filename, numeric_columns, text_columns, missing_values)
+        text_summary = self._generate_text_summary(df, row_count, filename, numeric_columns, text_columns, missing_values)
         
         summary = {
-            "row_count": len(df_full),
+            "row_count": row_count,
             "column_count": len(df.columns),
             "columns": df.columns.tolist(),
             "numeric_columns": numeric_columns,
@@ -124,9 +167,84 @@ class CSVService:
         
         return csv_data, summary
     
+    def _read_csv_arrow(self, content: Union[str, bytes]) -> Tuple[pd.DataFrame, int]:
+        """
+        Fast path: multi-threaded pyarrow parser straight from the bytes.
+        Keeps the C engine's output shape: the same NA tokens become missing values (in text
+        columns too), all-empty columns are float64, date/time values stay as their original text
+        and non-UTF-8 files are decoded as latin-1. Files Arrow can't read the same way (repeated
+        headers, integers beyond int64) are read by the C engine instead.
+        
+        Returns the first MAX_ROWS_CONTEXT rows as a DataFrame plus the total row count;
+        the remaining rows stay in compact Arrow buffers and are never converted to pandas.
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        
+        table = pa_csv.read_csv(
+            pa.BufferReader(content),
+            convert_options=pa_csv.ConvertOptions(null_values=NA_VALUES, strings_can_be_null=True)
+        )
+        
+        if len(set(table.column_names)) < table.num_columns:
+            # Repeated headers: the C engine renames them ("a", "a.1", ...)
+            return self._read_csv_c_engine(content)
+        
+        if any(
+            pa.types.is_floating(field.type) and (pc.max(pc.abs(column)).as_py() or 0) >= 2 ** 63
+            for field, column in zip(table.schema, table.columns)
+        ):
+            # Integers beyond int64 became (lossy) doubles; the C engine keeps them exact as uint64
+            return self._read_csv_c_engine(content)
+        
+        # pyarrow always infers date/timestamp types and reads undecodable text as binary;
+        # re-read those columns as strings (latin-1 if the file isn't valid UTF-8)
+        as_text = [
+            field.name for field in table.schema
+            if pa.types.is_temporal(field.type) or pa.types.is_binary(field.type)
+        ]
+        if as_text:
+            has_binary = any(pa.types.is_binary(table.schema.field(name).type) for name in as_text)
+            table = pa_csv.read_csv(
+                pa.BufferReader(content),
+                read_options=pa_csv.ReadOptions(encoding="latin-1" if has_binary else "utf8"),
+                convert_options=pa_csv.ConvertOptions(
+                    column_types={name: pa.string() for name in as_text},
+                    null_values=NA_VALUES,
+                    strings_can_be_null=True
+                )
+            )
+        
+        # All-empty columns come back with Arrow's null type; the C engine reads them as float64 NaN
+        if any(pa.types.is_null(field.type) for field in table.schema):
+            table = table.cast(pa.schema([
+                pa.field(field.name, pa.float64()) if pa.types.is_null(field.type) else field
+                for field in table.schema
+            ]))
+        
+        row_count = table.num_rows
+        table = table.slice(0, self.MAX_ROWS_CONTEXT)
+        return table.to_pandas(self_destruct=True), row_count
+    
+    def _read_csv_c_engine(self, content: bytes) -> Tuple[pd.DataFrame, int]:
+        """pandas C engine, same return shape as _read_csv_arrow"""
+        df = self._read_csv(content)
+        return df.head(self.MAX_ROWS_CONTEXT), len(df)
+    
+    def _read_csv(self, content: Union[str, bytes], **kwargs) -> pd.DataFrame:
+        """Read CSV from a string or from raw bytes without decoding them up front"""
+        if isinstance(content, str):
+            return pd.read_csv(StringIO(content), **kwargs)
+        
+        try:
+            return pd.read_csv(BytesIO(content), encoding="utf-8", **kwargs)
+        except UnicodeDecodeError:
+            return pd.read_csv(BytesIO(content), encoding="latin-1", **kwargs)
+    
     def _generate_text_summary(
         self,
         df: pd.DataFrame,
+        row_count: int,
         filename: str,
         numeric_columns: List[str],
         text_columns: List[str],
@@ -135,7 +253,7 @@ class CSVService:
         """Generate human-readable text summary of the dataset"""
         lines = [
             f"**Dataset: {filename}**",
-            f"- **Total rows**: {len(df):,}",
+            f"- **Total rows**: {row_count:,}",
             f"- **Total columns**: {len(df.columns)}",
             "",
             f"**Numeric columns** ({len(numeric_columns)}): {', '.join(numeric_columns) if numeric_columns else 'None'}",
@@ -148,7 +266,7 @@ class CSVService:
             lines.append("")
             lines.append("**Missing values:**")
             for col, count in sorted(cols_with_missing.items(), key=lambda x: -x[1])[:5]:
-                pct = (count / len(df)) * 100
+                pct = (count / row_count) * 100
                 lines.append(f"  - {col}: {count:,} ({pct:.1f}%)")
         else:
             lines.append("")
@@ -156,13 +274,8 @@ class CSVService:
         
         return "\n".join(lines)
     
-# Singleton instance
-_csv_service: Optional[CSVService] = None
-
-
+# Singleton instance (also usable as a FastAPI dependency)
+@lru_cache(maxsize=1)
 def get_csv_service() -> CSVService:
     """Get or create CSV service instance"""
-    global _csv_service
-    if _csv_service is None:
-        _csv_service = CSVService()
-    return _csv_service
+    return CSVService()
@@ -0,0 +1,64 @@
+"""
+Shared outbound HTTP clients
+One pooled httpx.AsyncClient per process and purpose, so TCP/TLS connections are reused across requests
+"""
+from typing import Optional
+import httpx
+
+# Bound outbound sockets (e.g. CSV URL fetches)
+MAX_CONNECTIONS = 50
+MAX_KEEPALIVE_CONNECTIONS = 20
+
+# LLM API (Groq): many concurrent streams to one host, multiplexed over HTTP/2 and kept warm
+LLM_MAX_CONNECTIONS = 512
+LLM_MAX_KEEPALIVE_CONNECTIONS = 256
+LLM_KEEPALIVE_EXPIRY = 60  # seconds
+# Long read timeout: the gap before the first streamed token can be large
+LLM_TIMEOUT = httpx.Timeout(connect=5.0, read=120.0, write=30.0, pool=5.0)
+
+
+# Singleton instances
+_http_client: Optional[httpx.AsyncClient] = None
+_llm_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get or create the shared HTTP client"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=30.0,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS
+            )
+        )
+    return _http_client
+
+
+def get_llm_http_client() -> httpx.AsyncClient:
+    """Get or create the HTTP client used by the LLM API client"""
+    global _llm_http_client
+    if _llm_http_client is None:
+        _llm_http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=LLM_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+            )
+        )
+    return _llm_http_client
+
+
+async def close_http_client():
+    """Close the shared HTTP clients (called on app shutdown)"""
+    global _http_client, _llm_http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    if _llm_http_client is not None:
+        await _llm_http_client.aclose()
+        _llm_http_client = None
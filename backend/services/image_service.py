@@ -0,0 +1,41 @@
+"""
+Image Service - Prepares images for the vision model
+Images travel to the LLM as base64 inside JSON, so every byte saved here is saved on each request
+"""
+from typing import Tuple
+from io import BytesIO
+from PIL import Image, UnidentifiedImageError
+
+MAX_LLM_IMAGE_SIDE = 1024  # Longest side sent to the model, in pixels
+LLM_JPEG_QUALITY = 75
+
+
+def shrink_image_for_llm(content: bytes, content_type: str) -> Tuple[bytes, str]:
+    """
+    Downscale an image to fit MAX_LLM_IMAGE_SIDE and re-encode it as JPEG.
+
+    Returns (bytes, MIME type). The original is returned unchanged when the result
+    isn't smaller (e.g. small PNG icons) or the image can't be decoded.
+    """
+    try:
+        with Image.open(BytesIO(content)) as image:
+            image.thumbnail((MAX_LLM_IMAGE_SIDE, MAX_LLM_IMAGE_SIDE))
+
+            # JPEG has no alpha channel: flatten transparency onto white
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+
+            buffer = BytesIO()
+            image.save(buffer, "JPEG", quality=LLM_JPEG_QUALITY, optimize=True)
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        return content, content_type
+
+    shrunk = buffer.getvalue()
+    if len(shrunk) >= len(content):
+        return content, content_type
+    return shrunk, "image/jpeg"
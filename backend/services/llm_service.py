@@ -2,131 +2,64 @@
 LLM Service - Handles communication with Groq API
 Supports text chat, image analysis, and CSV data analysis
 """
-from typing import List, Optional, Dict, Any, AsyncGenerator
+from typing import List, Optional, Dict, Any, AsyncGenerator, Callable, Tuple
+from functools import lru_cache, cache
+from contextlib import asynccontextmanager
+from collections import OrderedDict
 import os
-import json
+import re
+import base64
+import binascii
+import hashlib
+import threading
+import time
+import orjson
+import asyncio
 from openai import AsyncOpenAI
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+
+from services.http_client import get_llm_http_client
+from services.image_service import shrink_image_for_llm
+
+from database.cache import (
+    response_cache_enabled,
+    response_cache_key,
+    get_cached_response,
+    set_cached_response
+)
 
 load_dotenv()
 
-class LLMService:
-    def __init__(self):
-        api_key = os.getenv("GROQ_API_KEY")
-        if not api_key:
-            raise ValueError("GROQ_API_KEY not found in environment variables")
-        
-        # Groq API is compatible with OpenAI SDK
-        self.client = AsyncOpenAI(
-            api_key=api_key,
-            base_url="https://api.groq.com/openai/v1"
-        )
-        # Groq models - llama-4-scout supports vision
-        self.model = "meta-llama/llama-4-scout-17b-16e-instruct"
-        self.vision_model = "meta-llama/llama-4-scout-17b-16e-instruct"  # Model for vision
-        self.fallback_model = "llama-3.3-70b-versatile"  # Fallback for text-only
-        
-        # Llama 4 Scout supports vision
-        self.supports_vision = True
-    
-    
-    async def generate_response_stream(
-        self,
-        message: str,
-        history: List[dict],
-        image_base64: Optional[str] = None,
-        csv_context: Optional[dict] = None,
-        csv_summary: Optional[str] = None,
-    ) -> AsyncGenerator[str, None]:
-        """
-        Generate AI response with streaming.
-        Yields chunks of text as they're generated.
-        """
-        # Build system prompt
-        system_prompt = self._build_system_prompt(csv_context, csv_summary)
-        
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # Add conversation history (limit to save tokens)
-        for msg in history[-15:]:
-            if msg["content"].startswith("[Uploaded") or msg["content"].startswith("[Loaded"):
-                continue
-            messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
-        
-        # Build current message
-        if image_base64 and self.supports_vision:
-            messages.append({
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": message},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}",
-                            "detail": "auto"
-                        }
-                    }
-                ]
-            })
-        else:
-            messages.append({"role": "user", "content": message})
-        
-        # Call API with streaming
-        try:
-            # Use vision model if image is provided
-            model_to_use = self.vision_model if (image_base64 and self.supports_vision) else self.model
-            
-            stream = await self.client.chat.completions.create(
-                model=model_to_use,
-                messages=messages,
-                max_tokens=2000,
-                temperature=0.7,
-                stream=True
-            )
-            
-            async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
-                    
-        except Exception as e:
-            # print(f"[LLM] Error with primary model: {str(e)}")
-            # Try fallback model with streaming (text only)
-            try:
-                # Remove image from messages for fallback
-                fallback_messages = []
-                for msg in messages:
-                    if isinstance(msg.get("content"), list):
-                        # Extract text only
-                        text_content = next((c["text"] for c in msg["content"] if c["type"] == "text"), "")
-                        fallback_messages.append({"role": msg["role"], "content": f"[Ảnh đã được gửi nhưng model không thể xử lý]\n{text_content}"})
-                    else:
-                        fallback_messages.append(msg)
-                
-                stream = await self.client.chat.completions.create(
-                    model=self.fallback_model,
-                    messages=fallback_messages,
-                    max_tokens=2000,
-                    temperature=0.7,
-                    stream=True
-                )
-                
-                async for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        yield chunk.choices[0].delta.content
-                        
-            except Exception as fallback_error:
-                yield f"I apologize, but I encountered an error: {str(e)}"
-    
-    def _build_system_prompt(
-        self, 
-        csv_context: Optional[dict], 
-        csv_summary: Optional[str]
-    ) -> str:
-        """Build system prompt with context about available data"""
-        base_prompt = """You are a helpful AI assistant with the following capabilities:
+# Streamed tokens are forwarded in batches (see LLMService._coalesce_stream)
+STREAM_N = int(os.getenv("LLM_STREAM_N", 4))
+STREAM_MAX_DELAY = float(os.getenv("LLM_STREAM_MAX_DELAY", 0.02))  # seconds
+
+# Seconds without a first token from the primary model before the fallback model is asked too
+# (text-only requests, see LLMService._open_stream_with_fallback); 0 disables hedging
+HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", 0.8))
+
+# Conversation history sent with each request, in (estimated) tokens. The Llama tokenizer isn't
+# available here, so a rough ~4 characters per token is used; the history query's row limit
+# (get_message_history_for_llm) still caps the message count
+HISTORY_TOKEN_BUDGET = int(os.getenv("LLM_HISTORY_TOKEN_BUDGET", 8000))
+CHARS_PER_TOKEN = 4
+
+# Opt-in: end chart-first replies right after the chart block (see LLMService._stop_after_leading_chart).
+# Off by default because it drops any explanation the model writes after the chart
+STOP_AFTER_CHART = os.getenv("LLM_STOP_AFTER_CHART", "0") == "1"
+_CHART_OPEN = "```chart"
+_CHART_CLOSE = "\n```"
+
+# Groq API calls in flight per process, and an optional requests-per-minute cap (0 = unlimited)
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", 32))
+GROQ_MAX_RPM = int(os.getenv("GROQ_MAX_RPM", 0))
+
+# Static part of the system prompt, built once at import. Sent as its own (first) system
+# message so the prompt prefix is byte-identical across requests and provider-side
+# prompt caching can reuse it; per-conversation CSV context goes in a second message.
+_BASE_SYSTEM_PROMPT = """You are a helpful AI assistant with the following capabilities:
 
 1. **General Conversation**: Engage in helpful, friendly conversations.
 
@@ -314,18 +247,479 @@ class LLMService:
 - Always be helpful and accurate
 - Respond in the same language as the user's question"""
 
-        if csv_context and csv_summary:
-            # Build detailed CSV context
-            columns_info = ", ".join(csv_context.get('columns', []))
-            numeric_cols = csv_context.get('numeric_columns', [])
-            text_cols = csv_context.get('text_columns', [])
-            numeric_stats = csv_context.get('numeric_stats', {})
-            missing_values = csv_context.get('missing_values', {})
-            sample_rows = csv_context.get('sample_rows', [])
-            
-            csv_info = f"""
+# CSV prompt sections kept in memory (see LLMService._build_system_prompt)
+CSV_PROMPT_CACHE_SIZE = 32
+
+# One numeric column in the CSV prompt section, filled with format_map(_StatFields(...))
+_STAT_TEMPLATE = """
+- **{col}**:
+  - Mean: {mean}, Median: {median}
+  - Min: {min}, Max: {max}
+  - Std: {std}, Count: {count}
+  - Missing: {missing}"""
+
+
+class _StatFields(dict):
+    """Column stats for _STAT_TEMPLATE; absent values render as N/A (missing count as 0)"""
+    
+    def __missing__(self, key: str):
+        return 0 if key == "missing" else "N/A"
+
+
+# Questions asking for a visualization (substring match, case-insensitive, one scan of the question)
+_CHART_KEYWORDS_RE = re.compile(r"plot|chart|graph|histogram|visualize|show me|draw", re.IGNORECASE)
+
+# Base64 prefixes of the supported image formats' magic bytes
+_BASE64_IMAGE_SIGNATURES = (
+    ("iVBORw0KGg", "image/png"),
+    ("/9j/", "image/jpeg"),
+    ("R0lGOD", "image/gif"),
+    ("UklGR", "image/webp"),
+)
+
+
+def _json_indented(value) -> str:
+    """Pretty-printed JSON for prompts (orjson: much faster than json.dumps with indent)"""
+    return orjson.dumps(value, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+
+# Shrunk pasted images, keyed by a digest of the pasted base64: the frontend re-sends the active
+# image with every message. Values are bounded by MAX_LLM_IMAGE_SIDE; inputs are never stored
+IMAGE_URL_CACHE_SIZE = 8
+_image_url_cache: "OrderedDict[str, str]" = OrderedDict()
+_image_url_cache_lock = threading.Lock()
+
+
+def to_image_data_url(image_base64: str) -> str:
+    """
+    Turn a pasted image (raw base64 or a data URL) into the data URL sent to the model,
+    downscaled and re-encoded by shrink_image_for_llm. Done once per request, the URL is then
+    passed through; shrunk results are memoized (see _image_url_cache).
+    The MIME type of raw base64 is detected from the image header, defaulting to JPEG.
+    """
+    key = hashlib.blake2b(image_base64.encode("ascii", "replace"), digest_size=16).hexdigest()
+    with _image_url_cache_lock:
+        cached = _image_url_cache.get(key)
+        if cached is not None:
+            _image_url_cache.move_to_end(key)
+            return cached
+    
+    if image_base64.startswith("data:"):
+        header, _, image_base64 = image_base64.partition(",")
+        mime = header[len("data:"):].split(";")[0] or "image/jpeg"
+    else:
+        mime = next((mime for signature, mime in _BASE64_IMAGE_SIGNATURES if image_base64.startswith(signature)), "image/jpeg")
+    
+    try:
+        content = base64.b64decode(image_base64)
+    except binascii.Error:
+        return f"data:{mime};base64,{image_base64}"
+    
+    shrunk, shrunk_mime = shrink_image_for_llm(content, mime)
+    if shrunk is content:
+        # Kept as-is: nothing expensive to memoize, and the value would be as large as the input
+        return f"data:{mime};base64,{image_base64}"
+    
+    image_url = f"data:{shrunk_mime};base64," + base64.b64encode(shrunk).decode("utf-8")
+    with _image_url_cache_lock:
+        _image_url_cache[key] = image_url
+        _image_url_cache.move_to_end(key)
+        while len(_image_url_cache) > IMAGE_URL_CACHE_SIZE:
+            _image_url_cache.popitem(last=False)
+    return image_url
+
 
-**Currently Loaded CSV Data:**
+class LLMService:
+    def __init__(self):
+        api_key = os.getenv("GROQ_API_KEY")
+        if not api_key:
+            raise ValueError("GROQ_API_KEY not found in environment variables")
+        
+        # Groq API is compatible with OpenAI SDK; requests go through the shared, tuned
+        # connection pool (HTTP/2, long keep-alive) instead of the SDK's default client
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url="https://api.groq.com/openai/v1",
+            http_client=get_llm_http_client()
+        )
+        # Groq models - llama-4-scout supports vision
+        self.model = "meta-llama/llama-4-scout-17b-16e-instruct"
+        self.vision_model = "meta-llama/llama-4-scout-17b-16e-instruct"  # Model for vision
+        self.fallback_model = "llama-3.3-70b-versatile"  # Fallback for text-only
+        
+        # Llama 4 Scout supports vision
+        self.supports_vision = True
+        
+        # Per-process limits on Groq API calls (see _throttle)
+        self._semaphore = asyncio.Semaphore(GROQ_MAX_CONCURRENCY)
+        self._rate_limiter = AsyncLimiter(GROQ_MAX_RPM, 60) if GROQ_MAX_RPM > 0 else None
+        
+        # CSV prompt sections by (file signature, summary); only touched from the event loop, so no lock
+        self._csv_prompt_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+    
+    
+    async def generate_response_stream(
+        self,
+        message: str,
+        history: List[dict],
+        image_url: Optional[str] = None,
+        csv_context: Optional[dict] = None,
+        csv_summary: Optional[str] = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        Generate AI response with streaming.
+        Yields chunks of text as they're generated.
+        image_url is a data URL (see to_image_data_url), sent to the model without copying.
+        """
+        # Build system prompt
+        system_prompt, csv_prompt = self._build_system_prompt(csv_context, csv_summary)
+        
+        # Build current message
+        if image_url and self.supports_vision:
+            current_message = {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": message},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url,
+                            "detail": "auto"
+                        }
+                    }
+                ]
+            }
+        else:
+            current_message = {"role": "user", "content": message}
+        
+        # Assembled in one go: static prompt first, CSV context as a separate system message
+        # (see _BASE_SYSTEM_PROMPT), then the conversation history (trimmed to a token budget; entries
+        # are already {"role", "content"} dicts without upload markers, see get_message_history_for_llm)
+        messages = [
+            {"role": "system", "content": system_prompt},
+            *([{"role": "system", "content": csv_prompt}] if csv_prompt else ()),
+            *self._trim_history(history),
+            current_message
+        ]
+        
+        # Use vision model if image is provided
+        model_to_use = self.vision_model if (image_url and self.supports_vision) else self.model
+        
+        # Exact-match response cache (opt-in, see database.cache): a hit is replayed as one chunk
+        cache_key = None
+        if response_cache_enabled():
+            cache_key = response_cache_key(model_to_use, messages)
+            cached = await run_in_threadpool(get_cached_response, cache_key)
+            if cached is not None:
+                yield cached
+                return
+        
+        # Call API with streaming. Text-only requests are hedged (see _open_stream_with_fallback);
+        # with an image the fallback model would lose it, so it is only used if the primary fails
+        hedge = HEDGE_AFTER > 0 and not (image_url and self.supports_vision)
+        # Built on first use only, then shared by the hedge and fallback paths. History entries
+        # are always plain text, so without an image in this turn there is nothing to strip
+        if isinstance(current_message["content"], list):
+            fallback_messages = cache(lambda: self._strip_images(messages))
+        else:
+            fallback_messages = lambda: messages
+        try:
+            chunks, first, used_fallback = await self._open_stream_with_fallback(
+                model_to_use, messages, fallback_messages, hedge
+            )
+        except Exception as e:
+            yield f"I apologize, but I encountered an error: {str(e)}"
+            return
+        
+        parts = []
+        try:
+            if first is not None:
+                parts.append(first)
+                yield first
+            async for text in chunks:
+                parts.append(text)
+                yield text
+        except Exception as e:
+            if used_fallback:
+                yield f"I apologize, but I encountered an error: {str(e)}"
+                return
+            # Primary model failed mid-stream: continue with the fallback model (text only)
+            try:
+                chunks, first = await self._open_stream(self.fallback_model, fallback_messages())
+                if first is not None:
+                    yield first
+                async for text in chunks:
+                    yield text
+            except Exception:
+                yield f"I apologize, but I encountered an error: {str(e)}"
+            return
+        finally:
+            # Release the concurrency slot right away if the client went away mid-stream
+            await chunks.aclose()
+        
+        # Only complete primary-model answers are cached (not fallbacks, errors or aborted streams)
+        if cache_key and parts and not used_fallback:
+            await run_in_threadpool(set_cached_response, cache_key, "".join(parts))
+    
+    @staticmethod
+    def _trim_history(history: List[dict]) -> List[dict]:
+        """
+        Newest messages that fit in HISTORY_TOKEN_BUDGET, instead of a fixed message count:
+        a few long turns can't blow the context and many short ones aren't cut needlessly.
+        Tokens are estimated from the length (len() on str is O(1), nothing to precompute).
+        """
+        budget = HISTORY_TOKEN_BUDGET * CHARS_PER_TOKEN
+        start = len(history)
+        while start > 0:
+            budget -= len(history[start - 1]["content"])
+            if budget < 0:
+                break
+            start -= 1
+        return history[start:]
+    
+    async def _open_stream(
+        self,
+        model: str,
+        messages: List[dict],
+        acquired: Optional[asyncio.Event] = None
+    ) -> Tuple[AsyncGenerator[str, None], Optional[str]]:
+        """Start a streamed completion and wait for its first batch of text (None for an empty reply)"""
+        chunks = self._stream_completion(model, messages, acquired)
+        return chunks, await anext(chunks, None)
+    
+    async def _stream_completion(
+        self,
+        model: str,
+        messages: List[dict],
+        acquired: Optional[asyncio.Event] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Streamed completion, batched by _coalesce_stream. The concurrency slot is held until the
+        stream is exhausted, cancelled or closed (started generators are always finalized).
+        `acquired` is set once the slot is held and the request is about to be sent.
+        """
+        async with self._throttle():
+            if acquired is not None:
+                acquired.set()
+            stream = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=2000,
+                temperature=0.7,
+                stream=True
+            )
+            chunks = self._coalesce_stream(stream)
+            if STOP_AFTER_CHART:
+                chunks = self._stop_after_leading_chart(chunks)
+            try:
+                async for text in chunks:
+                    yield text
+            finally:
+                # Also ends generation server-side when we stop reading early
+                await stream.close()
+    
+    @staticmethod
+    async def _stop_after_leading_chart(chunks: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """
+        Pass the text through, but end a reply that opens with a ```chart block as soon as
+        that block is closed, instead of waiting for the tokens the model adds after it.
+        Replies starting with anything else are untouched.
+        """
+        lead = ""  # Reply so far without leading whitespace, while still a prefix of the opening fence
+        tail = None  # Inside the chart block: last scanned characters, to catch a fence split across pieces
+        async for text in chunks:
+            if tail is None:
+                lead = lead + text if lead else text.lstrip()
+                if lead.startswith(_CHART_OPEN):
+                    # The opener ends in this piece: scan what follows it
+                    scan_from = len(text) - (len(lead) - len(_CHART_OPEN))
+                    tail = ""
+                elif _CHART_OPEN.startswith(lead):
+                    yield text
+                    continue
+                else:
+                    # Not a chart-first reply: stop inspecting
+                    yield text
+                    async for text in chunks:
+                        yield text
+                    return
+            else:
+                scan_from = 0
+            
+            window = tail + text[scan_from:]
+            close = window.find(_CHART_CLOSE)
+            if close != -1:
+                yield text[:close + len(_CHART_CLOSE) - len(tail) + scan_from]
+                return
+            tail = window[-(len(_CHART_CLOSE) - 1):]
+            yield text
+    
+    @asynccontextmanager
+    async def _throttle(self):
+        """
+        Backpressure for Groq API calls: at most GROQ_MAX_CONCURRENCY in flight per process
+        (excess requests queue here instead of piling onto the connection pool and drawing 429s),
+        plus an optional GROQ_MAX_RPM requests-per-minute budget.
+        """
+        async with self._semaphore:
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire()
+            yield
+    
+    def _has_capacity(self) -> bool:
+        """Whether a Groq call could start right now without queueing in _throttle"""
+        if self._semaphore.locked():
+            return False
+        return self._rate_limiter is None or self._rate_limiter.has_capacity()
+    
+    async def _open_stream_with_fallback(
+        self,
+        model: str,
+        messages: List[dict],
+        fallback_messages: Callable[[], List[dict]],
+        hedge: bool
+    ) -> Tuple[AsyncGenerator[str, None], Optional[str], bool]:
+        """
+        Open the primary stream, switching to the (text-only) fallback model if it fails.
+        With hedge=True the fallback is also started once the primary has gone HEDGE_AFTER seconds
+        without producing text; whichever answers first is used and the other is cancelled,
+        so slow primary responses don't cost a full timeout + retry. The timer only starts once
+        the primary holds its throttle slot, and no hedge is sent while the throttle has no free
+        capacity: time spent queueing isn't a slow model, and hedging then would only double load.
+        
+        Returns (remaining chunks, first chunk, used_fallback); raises the primary's error if both fail.
+        """
+        acquired = asyncio.Event()
+        primary = asyncio.create_task(self._open_stream(model, messages, acquired))
+        tasks = [primary]
+        winner = None
+        try:
+            if hedge:
+                slot = asyncio.create_task(acquired.wait())
+                try:
+                    await asyncio.wait([primary, slot], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    slot.cancel()
+                if not primary.done():
+                    await asyncio.wait(tasks, timeout=HEDGE_AFTER)
+                if not primary.done() and self._has_capacity():
+                    tasks.append(asyncio.create_task(
+                        self._open_stream(self.fallback_model, fallback_messages())
+                    ))
+            
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Primary wins ties
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is None:
+                        winner = task
+                        chunks, first = task.result()
+                        return chunks, first, task is not primary
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    # Both answered at once: close the losing stream
+                    await task.result()[0].aclose()
+        
+        if len(tasks) == 1:
+            # Primary failed before a hedge was started: plain fallback
+            try:
+                chunks, first = await self._open_stream(self.fallback_model, fallback_messages())
+                return chunks, first, True
+            except Exception:
+                pass
+        raise primary.exception()
+    
+    @staticmethod
+    def _strip_images(messages: List[dict]) -> List[dict]:
+        """Copy of messages for the text-only fallback model, with images replaced by a notice"""
+        fallback_messages = []
+        for msg in messages:
+            if isinstance(msg["content"], list):
+                # Extract text only
+                text_content = ""
+                for part in msg["content"]:
+                    if part["type"] == "text":
+                        text_content = part["text"]
+                        break
+                fallback_messages.append({"role": msg["role"], "content": f"[Ảnh đã được gửi nhưng model không thể xử lý]\n{text_content}"})
+            else:
+                fallback_messages.append(msg)
+        return fallback_messages
+    
+    async def _coalesce_stream(self, stream) -> AsyncGenerator[str, None]:
+        """
+        Yield the streamed text in batches of up to STREAM_N tokens instead of one by one,
+        cutting SSE frames and event-loop wakeups downstream. A batch is also released once
+        its first token has waited STREAM_MAX_DELAY seconds, so slow streams stay responsive.
+        """
+        buffer = []
+        started = 0.0
+        try:
+            async for chunk in stream:
+                content = chunk.choices[0].delta.content
+                if not content:
+                    continue
+                if not buffer:
+                    started = time.monotonic()
+                buffer.append(content)
+                if len(buffer) >= STREAM_N or time.monotonic() - started >= STREAM_MAX_DELAY:
+                    yield "".join(buffer)
+                    buffer.clear()
+        except Exception:
+            # Don't lose the tokens already received when the stream breaks
+            if buffer:
+                yield "".join(buffer)
+            raise
+        
+        if buffer:
+            yield "".join(buffer)
+    
+    def _build_system_prompt(
+        self, 
+        csv_context: Optional[dict], 
+        csv_summary: Optional[str]
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Build the system prompt with context about available data.
+        Returns (static prompt, CSV context section or None when no CSV is loaded).
+        """
+        if not (csv_context and csv_summary):
+            return _BASE_SYSTEM_PROMPT, None
+        
+        # The CSV section only depends on the file and its summary, which stay the same for
+        # every turn about it: memoized by content signature (set at upload, see CSVService)
+        signature = csv_context.get('signature')
+        if not signature:
+            return _BASE_SYSTEM_PROMPT, self._build_csv_prompt(csv_context, csv_summary)
+        
+        key = (signature, csv_summary)
+        csv_info = self._csv_prompt_cache.get(key)
+        if csv_info is None:
+            csv_info = self._build_csv_prompt(csv_context, csv_summary)
+            self._csv_prompt_cache[key] = csv_info
+            while len(self._csv_prompt_cache) > CSV_PROMPT_CACHE_SIZE:
+                self._csv_prompt_cache.popitem(last=False)
+        self._csv_prompt_cache.move_to_end(key)
+        
+        return _BASE_SYSTEM_PROMPT, csv_info
+    
+    def _build_csv_prompt(self, csv_context: dict, csv_summary: str) -> str:
+        """Build the system prompt section describing the loaded CSV"""
+        # Build detailed CSV context
+        columns_info = ", ".join(csv_context.get('columns', []))
+        numeric_cols = csv_context.get('numeric_columns', [])
+        text_cols = csv_context.get('text_columns', [])
+        numeric_stats = csv_context.get('numeric_stats', {})
+        missing_values = csv_context.get('missing_values', {})
+        sample_rows = csv_context.get('sample_rows', [])
+        
+        parts = [f"""**Currently Loaded CSV Data:**
 - **Filename**: {csv_context.get('filename', 'Unknown')}
 - **Total Rows**: {csv_context.get('row_count', 'Unknown'):,}
 - **Total Columns**: {csv_context.get('column_count', len(csv_context.get('columns', [])))}
@@ -333,49 +727,45 @@ class LLMService:
 - **Numeric Columns** ({len(numeric_cols)}): {', '.join(numeric_cols) if numeric_cols else 'None'}
 - **Text Columns** ({len(text_cols)}): {', '.join(text_cols) if text_cols else 'None'}
 
-**Numeric Statistics:**"""
+**Numeric Statistics:**"""]
 
-            # Add numeric stats for each column
-            for col, stats in numeric_stats.items():
-                csv_info += f"""
-- **{col}**:
-  - Mean: {stats.get('mean', 'N/A')}, Median: {stats.get('median', 'N/A')}
-  - Min: {stats.get('min', 'N/A')}, Max: {stats.get('max', 'N/A')}
-  - Std: {stats.get('std', 'N/A')}, Count: {stats.get('count', 'N/A')}
-  - Missing: {stats.get('missing', 0)}"""
-
-            # Add missing values summary
-            cols_with_missing = {k: v for k, v in missing_values.items() if v > 0}
-            if cols_with_missing:
-                csv_info += "\n\n**Missing Values:**"
-                for col, count in sorted(cols_with_missing.items(), key=lambda x: -x[1])[:5]:
-                    row_count = csv_context.get('row_count', 1)
-                    pct = (count / row_count * 100) if row_count > 0 else 0
-                    csv_info += f"\n- {col}: {count:,} ({pct:.1f}%)"
-            else:
-                csv_info += "\n\n**Missing Values:** None"
+        # Add numeric stats for each column (pieces are joined once at the end)
+        parts.extend(
+            _STAT_TEMPLATE.format_map(_StatFields(stats, col=col))
+            for col, stats in numeric_stats.items()
+        )
+
+        # Add missing values summary
+        cols_with_missing = {k: v for k, v in missing_values.items() if v > 0}
+        if cols_with_missing:
+            parts.append("\n\n**Missing Values:**")
+            row_count = csv_context.get('row_count', 1)
+            for col, count in sorted(cols_with_missing.items(), key=lambda x: -x[1])[:5]:
+                pct = (count / row_count * 100) if row_count > 0 else 0
+                parts.append(f"\n- {col}: {count:,} ({pct:.1f}%)")
+        else:
+            parts.append("\n\n**Missing Values:** None")
 
-            # Add sample data (first 5 rows for context)
-            if sample_rows:
-                csv_info += f"\n\n**Sample Data (first {min(5, len(sample_rows))} rows):**\n"
-                csv_info += "```json\n"
-                csv_info += json.dumps(sample_rows[:5], indent=2, ensure_ascii=False)
-                csv_info += "\n```"
+        # Add sample data (first 5 rows for context)
+        if sample_rows:
+            parts.append(f"\n\n**Sample Data (first {min(5, len(sample_rows))} rows):**\n")
+            parts.append("```json\n")
+            # Precomputed at upload; CSVs stored before that are serialized here
+            parts.append(csv_context.get('sample_rows_json') or _json_indented(sample_rows[:5]))
+            parts.append("\n```")
 
-            csv_info += f"""
+        parts.append(f"""
 
 **Summary:** {csv_summary}
 
 When the user asks about "the data", "the dataset", "the CSV", "dữ liệu", etc., refer to this loaded data.
 Use the actual statistics provided above to answer questions accurately.
-For questions about specific columns, use the exact values from numeric_stats."""
-            
-            base_prompt += csv_info
+For questions about specific columns, use the exact values from numeric_stats.""")
         
-        return base_prompt
+        return "".join(parts)
     
-    async def analyze_image(self, image_base64: str, question: str = None) -> str:
-        """Specifically analyze an image"""
+    async def analyze_image(self, image_url: str, question: str = None) -> str:
+        """Specifically analyze an image (given as a data URL)"""
         if not self.supports_vision:
             return "**Lưu ý:** Model hiện tại chưa hỗ trợ phân tích hình ảnh. Ảnh đã được upload nhưng tôi không thể xem được nội dung."
         
@@ -393,7 +783,7 @@ For questions about specific columns, use the exact values from numeric_stats.""
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}",
+                            "url": image_url,
                             "detail": "high"
                         }
                     }
@@ -402,11 +792,12 @@ For questions about specific columns, use the exact values from numeric_stats.""
         ]
         
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=1500
-            )
+            async with self._throttle():
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=1500
+                )
             return response.choices[0].message.content
         except Exception as e:
             # Fallback to text model if vision fails
@@ -423,8 +814,7 @@ For questions about specific columns, use the exact values from numeric_stats.""
         Returns response and optional chart data
         """
         # Check if user is asking for a chart/visualization
-        chart_keywords = ["plot", "chart", "graph", "histogram", "visualize", "show me", "draw"]
-        needs_chart = any(keyword in question.lower() for keyword in chart_keywords)
+        needs_chart = bool(_CHART_KEYWORDS_RE.search(question))
         
         prompt = f"""You are a data analyst. Answer the following question about this dataset.
 
@@ -436,10 +826,10 @@ For questions about specific columns, use the exact values from numeric_stats.""
 - Summary: {csv_summary}
 
 **Numeric Statistics:**
-{json.dumps(csv_data.get('numeric_stats', {}), indent=2)}
+{_json_indented(csv_data.get('numeric_stats', {}))}
 
 **Sample Data (first 5 rows):**
-{json.dumps(csv_data.get('sample_rows', [])[:5], indent=2)}
+{csv_data.get('sample_rows_json') or _json_indented(csv_data.get('sample_rows', [])[:5])}
 
 **Question:** {question}
 
@@ -453,12 +843,13 @@ If the question asks for a visualization, describe what the chart would show."""
         ]
         
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=1500,
-                temperature=0.5
-            )
+            async with self._throttle():
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=1500,
+                    temperature=0.5
+                )
             
             return {
                 "answer": response.choices[0].message.content,
@@ -471,13 +862,8 @@ If the question asks for a visualization, describe what the chart would show."""
             }
 
 
-# Singleton instance
-_llm_service: Optional[LLMService] = None
-
-
+# Singleton instance (also usable as a FastAPI dependency)
+@lru_cache(maxsize=1)
 def get_llm_service() -> LLMService:
     """Get or create LLM service instance"""
-    global _llm_service
-    if _llm_service is None:
-        _llm_service = LLMService()
-    return _llm_service
+    return LLMService()
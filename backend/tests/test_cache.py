@@ -0,0 +1,40 @@
+"""
+Redis history cache: a history read before a concurrent write must not be cached
+"""
+import fakeredis
+import pytest
+
+import database.cache as cache
+
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    monkeypatch.setattr(cache, "_redis_client", fakeredis.FakeRedis())
+
+
+def test_history_is_cached():
+    version = cache.get_history_version("c1")
+    cache.set_cached_history("c1", 20, [{"role": "user", "content": "hi"}], version)
+
+    assert cache.get_cached_history("c1", 20) == [{"role": "user", "content": "hi"}]
+
+
+def test_invalidate_drops_cached_history():
+    cache.set_cached_history("c1", 20, [{"role": "user", "content": "hi"}], cache.get_history_version("c1"))
+    cache.invalidate_history("c1")
+
+    assert cache.get_cached_history("c1", 20) is None
+
+
+def test_stale_read_is_not_cached():
+    """Invalidation between the database read and the cache write"""
+    version = cache.get_history_version("c1")
+    stale = [{"role": "user", "content": "hi"}]
+    cache.invalidate_history("c1")  # Concurrent add_message
+    cache.set_cached_history("c1", 20, stale, version)
+
+    assert cache.get_cached_history("c1", 20) is None
+
+    # The next read starts from the new generation and is cached again
+    cache.set_cached_history("c1", 20, stale, cache.get_history_version("c1"))
+    assert cache.get_cached_history("c1", 20) == stale
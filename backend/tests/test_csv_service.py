@@ -0,0 +1,54 @@
+"""
+CSVService parsing: the Arrow fast path must describe files the way the pandas C engine
+(the original reader) does
+"""
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+from services.csv_service import CSVService
+
+
+def _parse(content: bytes):
+    return CSVService().parse_csv(content, "data.csv")
+
+
+@pytest.mark.parametrize("content", [
+    b"a,b,c,d\n1,2.5,x,y\n5,7.5,,\n",
+    b"a,t\n1,NA\n2,null\n3,N/A\n4,ok\n",
+    b"a,empty\n1,\n2,\n",
+    b"a,a,a.1,a\n1,2,3,4\n",
+    b"u\n18446744073709551615\n1\n",
+])
+def test_matches_c_engine(content):
+    expected = pd.read_csv(BytesIO(content))
+    csv_data, summary = _parse(content)
+
+    assert csv_data["columns"] == expected.columns.tolist()
+    assert csv_data["dtypes"] == {col: str(dtype) for col, dtype in expected.dtypes.items()}
+    assert csv_data["missing_values"] == expected.isnull().sum().astype(int).to_dict()
+    assert csv_data["sample_rows"] == expected.head(5).fillna("").to_dict(orient="records")
+
+
+def test_all_empty_column_is_numeric_without_stats():
+    csv_data, summary = _parse(b"a,empty\n1,\n2,\n")
+
+    assert summary["numeric_columns"] == ["a", "empty"]
+    assert summary["text_columns"] == []
+    assert "empty" not in summary["numeric_stats"]
+    assert summary["missing_values"]["empty"] == 2
+
+
+def test_large_unsigned_integers_stay_exact():
+    csv_data, summary = _parse(b"u\n18446744073709551615\n1\n")
+
+    assert csv_data["dtypes"] == {"u": "uint64"}
+    assert csv_data["sample_rows"][0]["u"] == 18446744073709551615
+
+
+def test_single_value_column_std_is_zero():
+    _, summary = _parse(b"a,b\n5,1\n,2\n")
+
+    assert summary["numeric_stats"]["a"]["std"] == 0
+    assert isinstance(summary["numeric_stats"]["a"]["std"], int)
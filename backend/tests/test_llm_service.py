@@ -0,0 +1,103 @@
+"""
+LLMService streaming: hedged fallback vs. the Groq throttle
+The Groq client is replaced by a fake whose per-model delay / reply is scripted.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import services.llm_service as llm_module
+from services.llm_service import LLMService
+
+
+class FakeStream:
+    """Stands in for openai's AsyncStream: async-iterable chunks plus close()"""
+
+    def __init__(self, parts):
+        self._parts = parts
+
+    async def __aiter__(self):
+        for part in self._parts:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part))])
+
+    async def close(self):
+        pass
+
+
+class FakeCompletions:
+    def __init__(self, replies):
+        self.replies = replies  # model -> (delay seconds, reply parts)
+        self.calls = []
+
+    async def create(self, model, messages, **kwargs):
+        self.calls.append(model)
+        delay, parts = self.replies[model]
+        await asyncio.sleep(delay)
+        return FakeStream(parts)
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setenv("GROQ_API_KEY", "test")
+    monkeypatch.setattr(llm_module, "HEDGE_AFTER", 0.05)
+    return LLMService()
+
+
+def _use_fake_client(service, replies):
+    completions = FakeCompletions(replies)
+    service.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return completions
+
+
+async def _reply(service):
+    return "".join([text async for text in service.generate_response_stream("hi", [])])
+
+
+def test_slow_primary_is_hedged_with_fallback(service):
+    completions = _use_fake_client(service, {
+        service.model: (0.5, ["primary"]),
+        service.fallback_model: (0, ["fallback"]),
+    })
+
+    assert asyncio.run(_reply(service)) == "fallback"
+    assert completions.calls == [service.model, service.fallback_model]
+
+
+def test_no_hedge_while_waiting_for_a_slot(service):
+    """Queueing behind a full semaphore must not count towards HEDGE_AFTER"""
+    completions = _use_fake_client(service, {
+        service.model: (0, ["primary"]),
+        service.fallback_model: (0, ["fallback"]),
+    })
+
+    async def run():
+        service._semaphore = asyncio.Semaphore(2)
+        for _ in range(2):
+            await service._semaphore.acquire()  # Other requests hold every slot
+        reply = asyncio.create_task(_reply(service))
+        await asyncio.sleep(0.2)  # Well past HEDGE_AFTER
+        assert completions.calls == []
+        for _ in range(2):
+            service._semaphore.release()
+        return await reply
+
+    assert asyncio.run(run()) == "primary"
+    assert completions.calls == [service.model]
+
+
+def test_no_hedge_when_semaphore_is_full(service):
+    """A slow primary holding the last free slot is not hedged, even if a slot frees up later"""
+    completions = _use_fake_client(service, {
+        service.model: (0.3, ["primary"]),
+        service.fallback_model: (0, ["fallback"]),
+    })
+
+    async def run():
+        service._semaphore = asyncio.Semaphore(2)
+        await service._semaphore.acquire()  # Another request holds one of the two slots
+        asyncio.get_running_loop().call_later(0.1, service._semaphore.release)
+        return await _reply(service)
+
+    assert asyncio.run(run()) == "primary"
+    assert completions.calls == [service.model]